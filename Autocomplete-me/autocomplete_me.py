@@ -4,6 +4,21 @@
 
 import heapq
 import sys
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+# structures read_terms can build: a Trie, a FrozenTrie or a SortedIndex
+ENGINES = ('trie', 'frozen', 'sorted')
+
+# header of a FrozenTrie snapshot: magic, number of nodes, bytes of words, cache;
+# the arrays follow in native byte order, each starting on 8 bytes
+SNAPSHOT_MAGIC = b'ACTRIE01'
+SNAPSHOT_HEADER = struct.Struct('8sqqq')
+SNAPSHOT_ARRAYS = (('first', 'q', 1), ('label', 'I', 0), ('weight', 'q', 0), ('maxWeight', 'q', 0),
+				   ('isWord', 'B', 0), ('wordStart', 'q', 1))
 
 
 class Node:
@@ -14,13 +29,17 @@ class Node:
 		weight -- weight of word stored in the node, -1 by default
 	    maxWeight -- max weight of words in the node's children, -1 by default
 	    children -- dict for all children nodes
+	    top -- memoized completions of the node when the trie caches them, None until queried
 	'''
+	__slots__ = ('word', 'isWord', 'weight', 'maxWeight', 'children', 'top')
+
 	def __init__(self, word = None, weight = -1):
 		self.word = word
 		self.isWord = False
 		self.weight = weight
 		self.maxWeight = -1
 		self.children = {}
+		self.top = None
 
 	def __lt__(self, other):
 		'''less-than comparison between two nodes'''
@@ -34,9 +53,11 @@ class Trie:
 
 	Attributes:
 		root -- empty node where Trie begins
+		cache -- the k up to which each queried node memoizes its completions, 0 for none
 	'''
-	def __init__(self):
+	def __init__(self, cache = 0):
 		self.root = Node()
+		self.cache = int(cache)
 
 	def insert(self, node):
 		# insert a node to the trie'''
@@ -44,6 +65,9 @@ class Trie:
 		word = node.word
 
 		for letter in word:
+			# completions memoized along the path may change
+			current.top = None
+
 			# store the max weight among all the nodes within this subtree
 			if current.maxWeight < node.weight:
 				current.maxWeight = node.weight
@@ -53,11 +77,71 @@ class Trie:
 			
 			current = current.children[letter]
 
+		# a lower weight for a word already in the trie may lower the max weights above it
+		if current.isWord and node.weight < current.weight:
+			self.update(word, node.weight)
+			return
+
 		# add weights to the node when the loop ends	
+		current.top = None
 		current.word = word
 		current.isWord = True
 		current.weight = node.weight
 
+	def update(self, word, weight):
+		# set the weight of a word, inserting it if it isn't in the trie
+		self.update_many([(word, weight)])
+
+	def delete(self, word):
+		# remove a word, and the nodes left without any word below them
+		self.update_many([(word, None)])
+
+	def update_many(self, changes):
+		'''apply a batch of weight changes, and repair the max weights once
+
+		every node on the path of a changed word is repaired from its children,
+		deepest first, so each node is visited once per batch however many of
+		its words changed
+
+		Arguments:
+		changes -- iterable of (word, weight), a weight of None deletes the word'''
+		touched = {}
+
+		try:
+			for word, weight in changes:
+				current, path = self.root, [(0, self.root, None, None)]
+				for depth, letter in enumerate(word, 1):
+					if letter not in current.children:
+						if weight is None:
+							raise LookupError("Word doesn't exist in the trie.")
+						current.children[letter] = Node()
+					parent, current = current, current.children[letter]
+					path.append((depth, current, parent, letter))
+
+				if weight is None:
+					if not current.isWord:
+						raise LookupError("Word doesn't exist in the trie.")
+					current.word, current.isWord, current.weight = None, False, -1
+				else:
+					current.word, current.isWord, current.weight = word, True, weight
+
+				for depth, node, parent, letter in path:
+					touched[node] = (depth, parent, letter)
+
+		# the changes applied before an error are repaired too
+		finally:
+			for node, (depth, parent, letter) in sorted(touched.items(), key=lambda item: -item[1][0]):
+				node.top = None
+				if parent is not None and not node.isWord and not node.children:
+					del parent.children[letter]
+					continue
+
+				node.maxWeight = -1
+				for child in node.children.values():
+					weight = max(child.weight if child.isWord else -1, child.maxWeight)
+					if node.maxWeight < weight:
+						node.maxWeight = weight
+
 	def search(self, string):
 		# given a string, find the node containing the string
 		current = self.root
@@ -70,20 +154,314 @@ class Trie:
 		return current
 
 
-def read_terms(file):
+class FrozenNode:
+	'''View of one node of a FrozenTrie, with the attributes of a Node.
+
+	Attributes:
+		trie -- the FrozenTrie holding the node
+		index -- number of the node in the trie's arrays
 	'''
-	given a text file, construct a trie'''
-	trie = Trie()
+	__slots__ = ('trie', 'index')
 
-	if len(str(file).strip())==0:
-		raise ValueError("Argument must be a valid text file.")
+	def __init__(self, trie, index):
+		self.trie = trie
+		self.index = index
+
+	def __lt__(self, other):
+		'''less-than comparison between two nodes, as for Node'''
+		if self.maxWeight >= other.maxWeight:
+			return True
+		return False
+
+	@property
+	def word(self):
+		if not self.trie.isWord[self.index]:
+			return None
+		start, end = self.trie.wordStart[self.index], self.trie.wordStart[self.index + 1]
+		return bytes(self.trie.words[start:end]).decode('utf-8')
+
+	@property
+	def isWord(self):
+		return bool(self.trie.isWord[self.index])
+
+	@property
+	def weight(self):
+		return self.trie.weight[self.index]
+
+	@property
+	def maxWeight(self):
+		return self.trie.maxWeight[self.index]
+
+	@property
+	def children(self):
+		trie = self.trie
+		return dict((chr(trie.label[child]), FrozenNode(trie, child))
+					for child in range(trie.first[self.index], trie.first[self.index + 1]))
+
+	@property
+	def top(self):
+		return self.trie.tops.get(self.index)
+
+	@top.setter
+	def top(self, items):
+		self.trie.tops[self.index] = items
+
+
+class FrozenTrie:
+	'''Read-only trie flattened into typed arrays, queried by autocomplete like a Trie.
+
+	nodes are numbered breadth-first from the root, so the children of node i
+	are the nodes first[i] to first[i+1]-1, in the order they were inserted
+
+	Attributes:
+		first -- number of the first child of every node, and the number of nodes last
+		label -- code point of the letter leading to every node, 0 for the root
+		weight, maxWeight, isWord -- the attributes of every node, as in Node
+		wordStart -- offset of every node's word in words, and the length of words last
+		words -- utf-8 bytes of the words of all nodes, in node order
+		cache -- the k up to which queried nodes memoize their completions, 0 for none
+		tops -- memoized completions by node number
+	'''
+	def __init__(self, trie, cache = None):
+		self.first, self.label = array('q'), array('I', [0])
+		self.weight, self.maxWeight = array('q'), array('q')
+		self.isWord, self.wordStart = array('B'), array('q')
+		words = []
+		length = 0
+
+		# breadth-first, a node's children get the next free numbers together
+		queue = deque([trie.root])
+		count = 1
+		while queue:
+			node = queue.popleft()
+			self.first.append(count)
+			for letter, child in node.children.items():
+				self.label.append(ord(letter))
+				queue.append(child)
+			count += len(node.children)
+
+			self.weight.append(node.weight)
+			self.maxWeight.append(node.maxWeight)
+			self.isWord.append(node.isWord)
+			self.wordStart.append(length)
+			if node.isWord:
+				words.append(node.word.encode('utf-8'))
+				length += len(words[-1])
+
+		self.first.append(count)
+		self.wordStart.append(length)
+		self.words = b''.join(words)
+		self.cache = trie.cache if cache is None else int(cache)
+		self.tops = {}
+
+	@classmethod
+	def from_terms(cls, items, cache = 0):
+		'''build the arrays directly from (weight, term) items, without any Node
+
+		the terms are sorted, so the terms of every node are a contiguous range
+		that splits into the ranges of its children with binary searches;
+		children are in letter order, and a repeated term keeps its last weight'''
+		latest = {}
+		for weight, word in items:
+			latest[word] = weight
+		terms = sorted(latest)
+		weights = array('q', [latest[term] for term in terms])
+
+		self = cls.__new__(cls)
+		self.first, self.label = array('q'), array('I', [0])
+		self.weight, self.maxWeight = array('q'), array('q')
+		self.isWord, self.wordStart = array('B'), array('q')
+		words = []
+		length = 0
+
+		# breadth-first over (first term, end of terms, depth) of every node
+		queue = deque([(0, len(terms), 0)])
+		count = 1
+		while queue:
+			lo, hi, depth = queue.popleft()
+			isWord = lo < hi and len(terms[lo]) == depth
+			self.first.append(count)
+			self.isWord.append(isWord)
+			self.weight.append(weights[lo] if isWord else -1)
+			self.wordStart.append(length)
+			if isWord:
+				words.append(terms[lo].encode('utf-8'))
+				length += len(words[-1])
+				lo += 1
+
+			# the max weight of the words below the node, as kept by Trie.insert
+			self.maxWeight.append(max(weights[lo:hi]) if lo < hi else -1)
+
+			while lo < hi:
+				letter = terms[lo][depth]
+				end = hi
+				if ord(letter) < sys.maxunicode:
+					end = bisect_left(terms, terms[lo][:depth] + chr(ord(letter) + 1), lo, hi)
+				self.label.append(ord(letter))
+				queue.append((lo, end, depth + 1))
+				count += 1
+				lo = end
+
+		self.first.append(count)
+		self.wordStart.append(length)
+		self.words = b''.join(words)
+		self.cache = int(cache)
+		self.tops = {}
+		return self
+
+	def save(self, path):
+		'''write the arrays to a binary snapshot, which load maps back into memory'''
+		with open(path, 'wb') as snapshot:
+			snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(self.weight), len(self.words), self.cache))
+			for name, typecode, _ in SNAPSHOT_ARRAYS:
+				data = bytes(memoryview(getattr(self, name)).cast('B'))
+				snapshot.write(data + b'\0' * (-len(data) % 8))
+			snapshot.write(bytes(self.words))
+
+	@classmethod
+	def load(cls, path):
+		'''map a snapshot written by save, the arrays are read from the file only when used'''
+		with open(path, 'rb') as snapshot:
+			buffer = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+		magic, nodes, length, cache = SNAPSHOT_HEADER.unpack_from(buffer)
+		if magic != SNAPSHOT_MAGIC:
+			raise ValueError("Argument must be a snapshot written by FrozenTrie.save.")
+
+		self = cls.__new__(cls)
+		view = memoryview(buffer)
+		offset = SNAPSHOT_HEADER.size
+		for name, typecode, extra in SNAPSHOT_ARRAYS:
+			size = (nodes + extra) * struct.calcsize(typecode)
+			setattr(self, name, view[offset:offset + size].cast(typecode))
+			offset += size + (-size % 8)
+		self.words = view[offset:offset + length]
 
+		self.buffer = buffer
+		self.cache = cache
+		self.tops = {}
+		return self
+
+	@property
+	def root(self):
+		return FrozenNode(self, 0)
+
+	def search(self, string):
+		# given a string, find the node containing the string
+		current = 0
+		string = str(string)
+
+		for letter in string:
+			code = ord(letter)
+			for child in range(self.first[current], self.first[current + 1]):
+				if self.label[child] == code:
+					current = child
+					break
+			else:
+				return None
+		return FrozenNode(self, current)
+
+
+class SortedIndex:
+	'''Terms in sorted order with a sparse table of range maxima, queried by autocomplete like a Trie.
+
+	the terms of a prefix are a contiguous range, found with two binary searches,
+	and its top weights are taken by splitting the range around each maximum
+
+	Attributes:
+		terms -- list of distinct terms, sorted
+		weights -- weight of every term, the last one read for a repeated term
+		table -- table[j][i] is the position of the largest weight of terms i to i+2**j-1
+	'''
+	def __init__(self, items):
+		latest = {}
+		for weight, word in items:
+			latest[word] = weight
+
+		self.terms = sorted(latest)
+		self.weights = array('q', [latest[term] for term in self.terms])
+
+		# each level doubles the length of the ranges, the leftmost position wins ties
+		w = self.weights
+		self.table = [array('I', range(len(w)))]
+		half = 1
+		while 2 * half <= len(w):
+			prev = self.table[-1]
+			self.table.append(array('I', [a if w[a] >= w[b] else b for a, b in zip(prev, prev[half:])]))
+			half *= 2
+
+	def prefix_range(self, prefix):
+		# positions lo to hi-1 of the terms starting with the prefix
+		lo = bisect_left(self.terms, prefix)
+		if ord(prefix[-1]) < sys.maxunicode:
+			return lo, bisect_left(self.terms, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo)
+
+		hi = lo
+		while hi < len(self.terms) and self.terms[hi].startswith(prefix):
+			hi += 1
+		return lo, hi
+
+	def argmax(self, lo, hi):
+		# position of the largest weight of terms lo to hi-1, two overlapping ranges of the table
+		level = (hi - lo).bit_length() - 1
+		a, b = self.table[level][lo], self.table[level][hi - (1 << level)]
+		return a if self.weights[a] >= self.weights[b] else b
+
+	def complete(self, prefix, k):
+		# the first kth items with largest weights among the terms starting with the prefix
+		lo, hi = self.prefix_range(prefix)
+		if lo == hi:
+			raise LookupError("Prefix doesn't exist in the index.")
+
+		wordList, q = [], []
+		best = self.argmax(lo, hi)
+		heapq.heappush(q, (-self.weights[best], best, lo, hi))
+
+		while len(q)>0 and len(wordList)<int(k):
+			weight, best, lo, hi = heapq.heappop(q)
+			wordList.append((-weight, self.terms[best]))
+
+			# the rest of the range is the parts left and right of its maximum
+			for lo, hi in [(lo, best), (best + 1, hi)]:
+				if lo < hi:
+					top = self.argmax(lo, hi)
+					heapq.heappush(q, (-self.weights[top], top, lo, hi))
+
+		return wordList
+
+
+def parse_terms(file):
+	'''
+	given a text file, yield the weight and term of every line after the first'''
 	with open(file, 'r') as txt:
 		next(txt)
 		for line in txt:
 			if line != '\n':
 				item = line.strip().split('\t')
-				trie.insert(Node(weight=int(item[0]), word=item[1]))
+				yield int(item[0]), item[1]
+
+
+def read_terms(file, cache = 0, engine = 'trie'):
+	'''
+	given a text file, construct a trie
+
+	Arguments:
+	file -- tab-separated text file of weights and terms, after a first line
+	cache -- the k up to which the trie memoizes completions, 0 for none
+	engine -- 'trie' for a Trie, 'frozen' for a FrozenTrie built in bulk, 'sorted' for a SortedIndex'''
+	if len(str(file).strip())==0:
+		raise ValueError("Argument must be a valid text file.")
+	if engine not in ENGINES:
+		raise ValueError("Engine must be one of {}.".format(ENGINES))
+
+	if engine == 'sorted':
+		return SortedIndex(parse_terms(file))
+	if engine == 'frozen':
+		return FrozenTrie.from_terms(parse_terms(file), cache)
+
+	trie = Trie(cache)
+	for weight, word in parse_terms(file):
+		trie.insert(Node(weight=weight, word=word))
 
 	return trie
 
@@ -94,19 +472,42 @@ def autocomplete(prefix, trie, k):
 
 	Arguments:
 	prefix -- string to be matched
-	trie -- trie built based on the given text file
+	trie -- trie (or FrozenTrie, SortedIndex) built based on the given text file
 	k -- number of items returned'''
 
-	wordList, q = [], []
-
 	if len(prefix.strip())==0:
 		raise ValueError("Prefix must be a valid string.")
 
+	if isinstance(trie, SortedIndex):
+		return trie.complete(prefix, k)
+
 	'''reach the node containing prefix, or raise error'''
 	current = trie.search(prefix)
 	if current is None:
 		raise LookupError("Prefix doesn't exist in the trie.")
 
+	# a caching trie searches a node once for its top trie.cache items,
+	# later queries of at most that many are sliced from the memo
+	if 0 < int(k) <= trie.cache:
+		if current.top is None:
+			current.top = complete(current, trie.cache)
+		return current.top[:int(k)]
+
+	return complete(current, k)
+
+
+def complete(current, k):
+
+	'''search the subtree of a node for the first kth items with largest weights
+
+	the items are popped best-first, so the first items of a larger k are the same
+
+	Arguments:
+	current -- node the completions start from
+	k -- number of items returned'''
+
+	wordList, q = [], []
+
 	if current.isWord:
 		heapq.heappush(q, (-current.weight, current, True))
 	heapq.heappush(q, (-current.maxWeight, current, False))
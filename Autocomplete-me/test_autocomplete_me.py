@@ -4,6 +4,8 @@
 
 import unittest
 import random
+import os
+import tempfile
 import autocomplete_me
 from autocomplete_me import Trie, Node
 
@@ -105,6 +107,140 @@ class test_autocomplete_me(unittest.TestCase):
 		self.assertEqual(len(autocomplete_me.autocomplete("apple", trie, 6)), 4)
 
 
+	def test_cache(self):
+		# test memoized completions give the same items, and are refreshed by insert
+		trie = autocomplete_me.read_terms("wiktionary.txt", cache=10)
+		for prefix in ["t", "th", "a", "qu"]:
+			for k in [1, 5, 10, 15]:
+				self.assertEqual(autocomplete_me.autocomplete(prefix, trie, k), autocomplete_me.autocomplete(prefix, wikTrie, k))
+		self.assertEqual(len(trie.search("t").top), 10)
+		self.assertEqual(trie.search("x").top, None)
+
+		trie.insert(Node(weight=9999999999, word="tx"))
+		self.assertEqual(trie.search("t").top, None)
+		self.assertEqual(autocomplete_me.autocomplete("t", trie, 2), [(9999999999, 'tx'), (5627187200, 'the')])
+
+
+	def test_frozen(self):
+		# test the array-backed trie answers like the trie it was built from
+		for trie in [wikTrie, pokTrie, babTrie, randTrie]:
+			frozen = autocomplete_me.FrozenTrie(trie)
+			self.assertEqual(frozen.root.maxWeight, trie.root.maxWeight)
+			for prefix in ["t", "th", "S", "Sh", "L", "Li", "a", "ac", "act"]:
+				if trie.search(prefix) is None:
+					self.assertRaises(LookupError, autocomplete_me.autocomplete, prefix, frozen, 5)
+				else:
+					self.assertEqual(autocomplete_me.autocomplete(prefix, frozen, 5), autocomplete_me.autocomplete(prefix, trie, 5))
+
+		frozen = autocomplete_me.FrozenTrie(wikTrie)
+		self.assertEqual(frozen.search("the").word, "the")
+		self.assertEqual(frozen.search("th").word, None)
+		self.assertEqual(frozen.search("the").maxWeight, 334039800)
+		self.assertRaises(ValueError, autocomplete_me.autocomplete, "  ", frozen, 5)
+
+		# equal weights are broken the same way
+		trie = autocomplete_me.Trie()
+		for word in ["ab", "ac", "abc", "acb", "a", "b"]:
+			trie.insert(Node(weight=1, word=word))
+		self.assertEqual(autocomplete_me.autocomplete("a", autocomplete_me.FrozenTrie(trie), 5), autocomplete_me.autocomplete("a", trie, 5))
+
+
+	def test_sorted(self):
+		# test the sorted-array index answers like the trie
+		index = autocomplete_me.read_terms("wiktionary.txt", engine="sorted")
+		for prefix in ["t", "th", "the", "a", "qu"]:
+			for k in [1, 5, 20]:
+				self.assertEqual(autocomplete_me.autocomplete(prefix, index, k), autocomplete_me.autocomplete(prefix, wikTrie, k))
+		self.assertRaises(LookupError, autocomplete_me.autocomplete, "xxx", index, 5)
+		self.assertRaises(ValueError, autocomplete_me.autocomplete, "  ", index, 5)
+
+		index = autocomplete_me.read_terms(randFile, engine="sorted")
+		for prefix in ["a", "c", "t"]:
+			if randTrie.search(prefix) is not None:
+				self.assertEqual(autocomplete_me.autocomplete(prefix, index, 5), autocomplete_me.autocomplete(prefix, randTrie, 5))
+
+		# a repeated term keeps its last weight, equal weights come in term order
+		index = autocomplete_me.SortedIndex([(5, "ab"), (3, "b"), (1, "aa"), (9, "ab"), (1, "a")])
+		self.assertEqual(index.terms, ["a", "aa", "ab", "b"])
+		self.assertEqual(autocomplete_me.autocomplete("a", index, 5), [(9, "ab"), (1, "a"), (1, "aa")])
+		self.assertRaises(ValueError, autocomplete_me.read_terms, "wiktionary.txt", engine="btree")
+
+
+	def test_snapshot(self):
+		# test the bulk build, and a snapshot mapped back from a file
+		frozen = autocomplete_me.read_terms("wiktionary.txt", engine="frozen")
+		for prefix in ["t", "th", "the", "a", "qu"]:
+			self.assertEqual(frozen.search(prefix).maxWeight, wikTrie.search(prefix).maxWeight)
+			self.assertEqual(autocomplete_me.autocomplete(prefix, frozen, 5), autocomplete_me.autocomplete(prefix, wikTrie, 5))
+
+		path = tempfile.mktemp()
+		frozen.save(path)
+		loaded = autocomplete_me.FrozenTrie.load(path)
+		self.assertEqual(len(loaded.weight), len(frozen.weight))
+		for prefix in ["S", "Sh", "t", "th", "a"]:
+			if frozen.search(prefix) is not None:
+				self.assertEqual(autocomplete_me.autocomplete(prefix, loaded, 5), autocomplete_me.autocomplete(prefix, frozen, 5))
+		self.assertRaises(LookupError, autocomplete_me.autocomplete, "xxx", loaded, 5)
+		self.assertRaises(ValueError, autocomplete_me.FrozenTrie.load, "wiktionary.txt")
+		os.remove(path)
+
+		frozen = autocomplete_me.FrozenTrie.from_terms([(5, "ab"), (3, "b"), (1, "aa"), (9, "ab"), (2, "a")])
+		self.assertEqual(frozen.search("a").weight, 2)
+		self.assertEqual(frozen.search("a").maxWeight, 9)
+		self.assertEqual(autocomplete_me.autocomplete("a", frozen, 5), [(9, "ab"), (2, "a"), (1, "aa")])
+
+
+	def test_update(self):
+		# test lowering, deleting and batch updating weights repair maxWeight
+		trie = autocomplete_me.Trie(cache=5)
+		trie.insert(Node(weight=123, word="apple"))
+		trie.insert(Node(weight=234, word="apples"))
+		trie.insert(Node(weight=67, word="applet"))
+		self.assertEqual(autocomplete_me.autocomplete("app", trie, 1), [(234, 'apples')])
+
+		trie.update("apples", 50)
+		self.assertEqual(trie.search("apple").maxWeight, 67)
+		self.assertEqual(trie.root.maxWeight, 123)
+		self.assertEqual(autocomplete_me.autocomplete("app", trie, 1), [(123, 'apple')])
+
+		# inserting a lower weight for a word repairs the path too
+		trie.insert(Node(weight=1, word="apple"))
+		self.assertEqual(trie.root.maxWeight, 67)
+
+		trie.delete("applet")
+		self.assertEqual(trie.search("applet"), None)
+		self.assertEqual(trie.search("apple").maxWeight, 50)
+		self.assertRaises(LookupError, trie.delete, "applet")
+		self.assertRaises(LookupError, trie.delete, "app")
+
+		trie.update_many([("apple", None), ("apples", None), ("banana", 7), ("band", 9)])
+		self.assertEqual(trie.search("a"), None)
+		self.assertEqual(trie.root.maxWeight, 9)
+		self.assertEqual(trie.search("ban").maxWeight, 9)
+		self.assertEqual(autocomplete_me.autocomplete("b", trie, 5), [(9, 'band'), (7, 'banana')])
+
+		# a random stream of changes, checked against a full sort
+		trie = autocomplete_me.read_terms(randFile)
+		words = {}
+		with open(randFile, 'r') as txt:
+			next(txt)
+			for line in txt:
+				item = line.strip().split('\t')
+				words[item[1]] = int(item[0])
+		changes = []
+		for word in random.sample(sorted(words), 300):
+			weight = random.choice([None, random.randint(0, 10**8)])
+			changes.append((word, weight))
+			if weight is None:
+				del words[word]
+			else:
+				words[word] = weight
+		trie.update_many(changes)
+		for prefix in ["a", "ac", "c", "th"]:
+			expected = sorted([(weight, word) for word, weight in words.items() if word.startswith(prefix)], reverse=True)[:5]
+			self.assertEqual([item[0] for item in autocomplete_me.autocomplete(prefix, trie, 5)], [item[0] for item in expected])
+
+
 def create_random_terms(file, n):
 	'''create a text file with randomly generated strings and weights
 
@@ -0,0 +1,255 @@
+# Title: Benchmark
+# Project: Shazam
+# Author: Sijia Liu
+# Date: Dec. 2017
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import tracemalloc
+import wave as wv
+import numpy as np
+from songClass import Song, window_signatures
+import database as db
+from hashing import Hashtable
+
+# the sample rate of the synthetic songs, and the percentiles of query latency reported
+SAMPLE_RATE = 44100
+PERCENTILES = (50, 90, 99)
+
+
+def write_noise(path, samples):
+	"""
+	write a stereo 16-bit '.wav' file with the same samples in both channels
+
+	params:
+		path: the file written, ending with '.wav'
+		samples: an array of mono samples between -32767 and 32767
+
+	"""
+
+	frames = np.repeat(np.clip(samples, -32767, 32767).astype('<i2'), 2)
+	output = wv.open(path, 'w')
+	output.setparams((2, 2, SAMPLE_RATE, 0, 'NONE', 'not compressed'))
+	output.writeframes(frames.tobytes())
+	output.close()
+
+
+def make_library(directory, n_songs, seconds, seed = 0):
+	"""
+	generate a library of random noise songs, the same for the same seed
+
+	params:
+		directory: the directory the songs are written to
+		n_songs: the number of songs
+		seconds: the length of every song in seconds
+		seed: the seed of the random songs
+
+	returns:
+		the sample arrays of the songs, in the order of their titles
+
+	"""
+
+	rng = np.random.RandomState(seed)
+	songs = []
+	for i in range(n_songs):
+		samples = rng.randint(-32767, 32768, SAMPLE_RATE * seconds)
+		write_noise(os.path.join(directory, 'song{:05d}.wav'.format(i)), samples)
+		songs.append(samples)
+	return songs
+
+
+def make_snippets(directory, songs, n_snippets, seconds, noise, seed = 0):
+	"""
+	cut snippets at random whole seconds of random songs, and add white noise
+
+	params:
+		directory: the directory the snippets are written to
+		songs: the sample arrays of the songs
+		n_snippets: the number of snippets
+		seconds: the length of every snippet in seconds
+		noise: the standard deviation of the noise, relative to the signal's
+		seed: the seed of the songs, offsets and noise picked
+
+	returns:
+		the paths of the snippets, and the index of the song of each
+
+	"""
+
+	rng = np.random.RandomState(seed)
+	paths, truth = [], []
+	for i in range(n_snippets):
+		song = rng.randint(len(songs))
+		start = SAMPLE_RATE * rng.randint(len(songs[song]) // SAMPLE_RATE - seconds + 1)
+		samples = songs[song][start: start + SAMPLE_RATE * seconds].astype(np.float64)
+		samples += rng.normal(0, noise * np.std(samples), len(samples))
+
+		paths.append(os.path.join(directory, 'snippet{:05d}.wav'.format(i)))
+		write_noise(paths[-1], samples)
+		truth.append(song)
+	return paths, truth
+
+
+class Stage(object):
+	"""
+	time a stage of the benchmark, and trace the peak memory it allocates"""
+
+	def __init__(self, results, name):
+		self.results = results
+		self.name = name
+
+	def __enter__(self):
+		tracemalloc.start()
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		seconds = time.perf_counter() - self.start
+		_, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+		self.results[self.name] = {'seconds': seconds, 'peak_bytes': peak}
+
+
+def run(n_songs = 20, song_seconds = 30, n_snippets = 50, snippet_seconds = 12,
+		noise = 0.1, Ks = (1, 5), database = False, batch_size = 1000, width = 10,
+		shift = 1, window_type = 'hann', seed = 0, **options):
+	"""
+	benchmark ingestion and identification on a synthetic library
+
+	ingestion is timed per stage: decoding the songs, analyzing the decoded
+	samples, writing the songs to the database as build_library does (only if
+	asked, since it recreates the tables of the library), and building the LSH
+	table; identification
+	is timed per snippet (analysis and query, titles aside), and its recall@K
+	is the fraction of noisy snippets whose song is among the songs of the K
+	nearest windows
+
+	params:
+		n_songs: the number of songs in the library
+		song_seconds: the length of every song in seconds
+		n_snippets: the number of snippets identified
+		snippet_seconds: the length of every snippet in seconds
+		noise: the standard deviation of the noise added to snippets, relative to the signal's
+		Ks: the values of K the recall is measured for
+		database: whether to time writing to the database, which must be running;
+				  its tables are recreated, so the library in it is lost
+		batch_size: the number of rows after which the songs so far are written, as for build_library
+		width, shift, window_type: the parameters of Song.analyzer
+		seed: the seed of the library and snippets
+		options: the parameters of the Hashtable, e.g. projection or num_probes
+
+	returns:
+		a dict of the configuration and the results, serializable as json
+
+	"""
+
+	if n_songs < 1 or n_snippets < 1:
+		raise ValueError("The numbers of songs and snippets must be positive integers.")
+	if snippet_seconds > song_seconds:
+		raise ValueError("The snippets must not be longer than the songs.")
+
+	config = dict(n_songs = n_songs, song_seconds = song_seconds, n_snippets = n_snippets,
+				  snippet_seconds = snippet_seconds, noise = noise, Ks = list(Ks),
+				  database = database, batch_size = batch_size, width = width, shift = shift,
+				  window_type = window_type, seed = seed, options = options)
+	stages = {}
+	directory = tempfile.mkdtemp()
+
+	try:
+		songs = make_library(directory, n_songs, song_seconds, seed)
+		snippet_directory = os.path.join(directory, 'snippets')
+		os.mkdir(snippet_directory)
+		paths, truth = make_snippets(snippet_directory, songs, n_snippets,
+									 snippet_seconds, noise, seed + 1)
+		titles = sorted(x for x in os.listdir(directory) if x.endswith('.wav'))
+
+		with Stage(stages, 'decode'):
+			samples = [Song(title, os.path.join(directory, title)).samples() for title in titles]
+
+		with Stage(stages, 'analyze'):
+			signatures = [window_signatures(song, SAMPLE_RATE, width, shift, window_type)
+						  for song in samples]
+		del samples
+
+		if database:
+			with Stage(stages, 'database'):
+				with db.connection() as conn:
+					db.Database(conn).create_table()
+
+					# whole songs in one transaction per batch, with db.write_songs
+					song_rows, signature_rows, entry = [], [], 0
+					for song_id, (title, song_signatures) in enumerate(zip(titles, signatures)):
+						song_rows.append((song_id, title))
+						for offset, signature in enumerate(song_signatures):
+							signature_rows.append((entry, song_id, offset, db.encode_signature(signature)))
+							entry += 1
+						if len(signature_rows) >= batch_size:
+							db.write_songs(conn, song_rows, signature_rows, [], [])
+							song_rows, signature_rows = [], []
+					if song_rows:
+						db.write_songs(conn, song_rows, signature_rows, [], [])
+
+		song_ids = np.concatenate([[i] * len(x) for i, x in enumerate(signatures)])
+		signatures = np.vstack(signatures)
+
+		lsh = Hashtable(width = width, shift = shift, window_type = window_type, **options)
+		with Stage(stages, 'lsh_build'):
+			lsh.build_lsh(signatures, song_ids)
+
+		# the latency of every snippet alone, then the recall of the K nearest windows
+		latencies, ranked, query = [], [], {}
+		with Stage(query, 'query'):
+			for path in paths:
+				start = time.perf_counter()
+				songs_id, _, distances = lsh.query_snippets([path], max(Ks))
+				latencies.append(time.perf_counter() - start)
+				order = np.argsort(distances[0], kind='stable')
+				ranked.append([int(x) for x in songs_id[0][order]])
+
+		recall = {str(K): float(np.mean([song in nearest[:K] for song, nearest in zip(truth, ranked)]))
+				  for K in Ks}
+	finally:
+		shutil.rmtree(directory)
+
+	audio_seconds = n_songs * song_seconds
+	for name in stages:
+		stages[name]['songs_per_second'] = n_songs / stages[name]['seconds']
+		stages[name]['audio_seconds_per_second'] = audio_seconds / stages[name]['seconds']
+
+	latencies = np.array(latencies)
+	return {
+		'config': config,
+		'environment': dict(python = platform.python_version(), numpy = np.__version__,
+							platform = platform.platform()),
+		'ingest': stages,
+		'signatures': int(len(signatures)),
+		'latency_seconds': dict([('mean', float(np.mean(latencies)))] +
+								[('p{}'.format(p), float(np.percentile(latencies, p)))
+								 for p in PERCENTILES]),
+		'query': dict(query['query'], snippets_per_second = n_snippets / query['query']['seconds']),
+		'recall_at_K': recall,
+		# the peak resident memory of this process, in kilobytes on linux
+		'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+	}
+
+
+def save(results, path):
+	"""
+	write the results of run to a json file, to compare across versions"""
+
+	with open(path, 'w') as f:
+		json.dump(results, f, indent = 2, sort_keys = True)
+
+
+if __name__ == '__main__':
+	results = run(database = '--database' in sys.argv)
+	paths = [x for x in sys.argv[1:] if not x.startswith('--')]
+	if paths:
+		save(results, paths[0])
+	else:
+		print(json.dumps(results, indent = 2, sort_keys = True))
@@ -6,26 +6,42 @@
 import psycopg2 as psql
 import numpy as np
 import os
-import re
+import io
+import struct
+import threading
+import multiprocessing as mp
+from contextlib import contextmanager
+from psycopg2.pool import ThreadedConnectionPool
 from songClass import Song
 
+DB_PARAMS = dict(dbname="sijial",
+				 user="sijial",
+				 password="Cigar077",
+				 host="sculptor.stat.cmu.edu")
+
+# framing of PostgreSQL's binary COPY format, used for bulk writes
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_TRAILER = struct.pack('!h', -1)
+
+SIGNATURE_COLUMNS = ('entry_id', 'song_id', 'window_offset', 'signature')
+FINGERPRINT_COLUMNS = ('hash', 'song_id', 'time_offset')
+
 
 class Database:
 	"""
 	a class that can build a database for songs and querying information"""
 	def __init__(self, conn = None, cur = None):
 
-		self.conn = self.connect()
-		self.cur = self.conn.cursor()
+		# a connection passed in (e.g. borrowed from a pool) is not closed here
+		self.owner = conn is None
+		self.conn = self.connect() if conn is None else conn
+		self.cur = self.conn.cursor() if cur is None else cur
 
 	def connect(self):
 		"""
 		connect to the database, and initiate self.conn and self.cur"""
 		try:
-			conn = psql.connect(dbname="sijial",
-								user="sijial",
-								password="Cigar077",
-								host="sculptor.stat.cmu.edu")
+			conn = psql.connect(**DB_PARAMS)
 			return conn
 		except psql.DatabaseError:
 			if conn:
@@ -34,14 +50,16 @@ class Database:
 
 	def create_table(self):
 		"""
-		create two tables for a music database
+		create three tables for a music database
 
 		returns:
-			two tables created in the database, one for song_ids and titles,
-			the other for entry_id, song_ids and signature
+			three tables created in the database, one for song_ids and titles,
+			one for entry_id, song_ids, window offset and signature, and one
+			for the peak-pair hashes of songs and their time offsets
 
 		"""
 		drop_tables_query = """
+			DROP TABLE IF EXISTS fingerprints;
 			DROP TABLE IF EXISTS signatures;
 			DROP TABLE IF EXISTS songs;
 			"""
@@ -54,134 +72,493 @@ class Database:
 			CREATE TABLE IF NOT EXISTS signatures (
 				entry_id SERIAL PRIMARY KEY,
 				song_id INTEGER REFERENCES songs(id),
-				signature VARCHAR NOT NULL,
+				window_offset INTEGER NOT NULL,
+				signature BYTEA NOT NULL,
 				UNIQUE (entry_id, song_id)
 			);
+			CREATE TABLE IF NOT EXISTS fingerprints (
+				hash INTEGER NOT NULL,
+				song_id INTEGER REFERENCES songs(id),
+				time_offset INTEGER NOT NULL
+			);
+			CREATE INDEX IF NOT EXISTS fingerprints_hash ON fingerprints (hash);
 			"""
 
 		self.cur.execute(drop_tables_query)
 		self.cur.execute(create_tables_query)
 		self.conn.commit()
-		self.conn.close()
+		if self.owner:
+			self.conn.close()
+
+
+class ConnectionPool(ThreadedConnectionPool):
+	"""
+	a thread-safe pool of database connections, where getconn waits for a
+	free connection instead of failing once maxconn connections are in use"""
+	def __init__(self, minconn = 1, maxconn = 8):
+
+		self.slots = threading.BoundedSemaphore(maxconn)
+		super().__init__(minconn, maxconn, **DB_PARAMS)
+
+	def getconn(self, key = None):
+		"""
+		borrow a connection, blocking while all of them are in use"""
+		self.slots.acquire()
+		try:
+			return super().getconn(key)
+		except Exception:
+			self.slots.release()
+			raise
+
+	def putconn(self, conn, key = None, close = False):
+		"""
+		give a borrowed connection back to the pool; its slot is freed even if
+		the pool fails to take it back"""
+		try:
+			super().putconn(conn, key, close)
+		finally:
+			self.slots.release()
+
+
+@contextmanager
+def connection(pool = None):
+	"""
+	borrow a connection from the pool, or open a fresh one if there is no pool
+
+	params:
+		pool: a ConnectionPool, None to open (and close) a dedicated connection
+
+	yields:
+		conn: an open connection; uncommitted work is rolled back on release
+
+	"""
+	if pool is None:
+		conn = Database().conn
+		try:
+			yield conn
+		finally:
+			conn.close()
+	else:
+		conn = pool.getconn()
+		try:
+			yield conn
+		finally:
+			# a dead connection can't be rolled back, and is closed instead of reused
+			broken = bool(conn.closed)
+			try:
+				if not broken:
+					conn.rollback()
+			except psql.Error:
+				broken = True
+			finally:
+				pool.putconn(conn, close = broken)
+
+
+def analyze_song(job):
+	"""
+	decode and analyze one song, run by the worker processes of build_library;
+	the song is streamed, so a worker holds one window of frames at a time for
+	its signatures, but the whole track for its fingerprints
+
+	params:
+		job: a tuple of (song_id, title, path, signatures, fingerprints, analysis)
+			 for one song, signatures and fingerprints telling which analyses
+			 to run, and analysis the keyword arguments of Song.analyzer
+
+	returns:
+		song_id, title, the signature matrix of the song (or None), and the
+		hashes and times of its fingerprints (or None)
+
+	"""
+	song_id, title, path, with_signatures, with_fingerprints, analysis = job
+	song = Song(title, path, stream = True)
+
+	signatures = song.analyzer(**analysis) if with_signatures else None
+	fingerprints = song.fingerprints() if with_fingerprints else None
+	return song_id, title, signatures, fingerprints
+
+
+def encode_signature(signature):
+	"""
+	pack a signature window into float32 bytes for the BYTEA signature column"""
+	return np.asarray(signature, dtype=np.float32).tobytes()
+
+
+def decode_signature(data):
+	"""
+	unpack a BYTEA signature into a float32 numpy array, without any parsing"""
+	return np.frombuffer(data, dtype=np.float32)
 
 
-def build_library(directory):
+def copy_rows(cur, table, columns, rows):
 	"""
-	build a music library given a directory path
+	write rows to a table with one binary COPY, instead of one INSERT per row
+
+	params:
+		cur: the cursor of an open connection
+		table: the name of the table
+		columns: a tuple of column names
+		rows: a list of tuples, holding integers (INTEGER), strings (TEXT)
+			  or bytes (BYTEA) in the order of columns
+
+	"""
+	buffer = io.BytesIO()
+	buffer.write(COPY_HEADER)
+
+	for row in rows:
+		buffer.write(struct.pack('!h', len(row)))
+		for value in row:
+			if isinstance(value, (int, np.integer)):
+				data = struct.pack('!i', int(value))
+			elif isinstance(value, str):
+				data = value.encode('utf-8')
+			else:
+				data = bytes(value)
+			buffer.write(struct.pack('!i', len(data)))
+			buffer.write(data)
+
+	buffer.write(COPY_TRAILER)
+	buffer.seek(0)
+
+	copy_query = "COPY {} ({}) FROM STDIN WITH (FORMAT binary)".format(table, ', '.join(columns))
+	cur.copy_expert(copy_query, buffer)
+
+
+def build_library(directory, workers = 1, batch_size = 1000, pool = None,
+				  signatures = True, fingerprints = False,
+				  width = 10, shift = 1, window_type = 'hann', store = None):
+	"""
+	build a music library given a directory path, or add to an existing one
+
+	songs already in the library (by title) are skipped, and new songs and
+	signatures are numbered after the existing ones, so earlier entries are
+	never touched
+
+	songs are decoded and analyzed across a pool of worker processes, and the
+	finished signatures are streamed back to this process, the single writer,
+	which bulk loads them with COPY in batches of one transaction each; a batch
+	only holds whole songs, so a song is committed together with all of its
+	rows, and a song that failed is ingested again by the next call
+
+	a library keeps the analyses it was built with: adding to it with other
+	analyses raises a ValueError, since the songs already in it would never
+	get the rows of the analyses they lack
 
 	params:
 		directory: a directory of songs in '.wav' format
+		workers: the number of worker processes, 1 analyzes in this process
+		batch_size: the number of rows after which the songs analyzed so far are
+					written, in one transaction
+		pool: a ConnectionPool to borrow the connection from, None to open one
+		signatures: whether to store the windowed signatures of songs
+		fingerprints: whether to store the peak-pair hash fingerprints of songs;
+					  each worker then decodes whole tracks, so its memory grows
+					  with the length of the longest song
+		width, shift, window_type: the parameters of Song.analyzer
+		store: a SignatureStore the signatures are also appended to, in entry order
 
 	returns:
 		True if successful
 
 	"""
-	conn = Database().conn
-	cur = conn.cursor()
+	if workers < 1:
+		raise ValueError("The number of workers must be a positive integer.")
+	if batch_size < 1:
+		raise ValueError("The batch size must be a positive integer.")
+
+	with connection(pool) as conn:
+		cur = conn.cursor()
+		cur.execute("SELECT title FROM songs;")
+		existing = set(row[0] for row in cur.fetchall())
+		first_song, entry = next_ids(cur)
+
+		cur.execute("SELECT EXISTS (SELECT 1 FROM signatures), EXISTS (SELECT 1 FROM fingerprints);")
+		stored = tuple(cur.fetchone())
+		if existing and stored != (signatures, fingerprints):
+			raise ValueError("The library holds signatures = {}, fingerprints = {}, "
+							 "and must be added to with the same analyses.".format(*stored))
+
+		songList = [x for x in os.listdir(directory) if x.endswith(".wav") and x not in existing]
+		analysis = dict(width = width, shift = shift, window_type = window_type)
+		jobs = [(first_song + i, title, os.path.join(directory, title),
+				 signatures, fingerprints, analysis) for i, title in enumerate(songList)]
+
+		proc_pool = mp.Pool(workers) if workers > 1 else None
+		results = proc_pool.imap(analyze_song, jobs) if proc_pool else map(analyze_song, jobs)
+
+		song_rows, signature_rows, fingerprint_rows, stored = [], [], [], []
+		try:
+			for song_id, title, song_signatures, song_fingerprints in results:
+				song_rows.append((song_id, title))
+				if song_signatures is not None:
+					for offset, signature in enumerate(song_signatures):
+						signature_rows.append((entry, song_id, offset, encode_signature(signature)))
+						entry += 1
+					stored.append((song_id, song_signatures))
+
+				# hashes are stored as signed INTEGERs with the same bits
+				if song_fingerprints is not None:
+					hashes, times = song_fingerprints
+					fingerprint_rows.extend((h, song_id, t) for h, t in
+											zip(hashes.view(np.int32).tolist(), times.tolist()))
+
+				if len(signature_rows) + len(fingerprint_rows) >= batch_size:
+					write_songs(conn, song_rows, signature_rows, fingerprint_rows, stored, store)
+					song_rows, signature_rows, fingerprint_rows, stored = [], [], [], []
+		except BaseException:
+			# the songs not yet written are dropped, no need to finish them
+			if proc_pool:
+				proc_pool.terminate()
+			raise
+		finally:
+			if proc_pool:
+				proc_pool.close()
+				proc_pool.join()
+
+		if song_rows:
+			write_songs(conn, song_rows, signature_rows, fingerprint_rows, stored, store)
+
+	return True
 
-	insert_song_query = """
-		INSERT INTO songs (id, title) 
-			VALUES (%s, %s) 
-		"""
-	insert_signature_query = """
-		INSERT INTO signatures (entry_id, song_id, signature)
-			VALUES (%s, %s, %s)
-		"""
 
-	songList = [x for x in os.listdir(directory) if x.endswith(".wav")]
-	for i in range(len(songList)):
-		cur.execute(insert_song_query, (i, songList[i]))
+def write_songs(conn, song_rows, signature_rows, fingerprint_rows, stored, store = None):
+	"""
+	write whole songs with COPY in one transaction: their titles, signatures
+	and fingerprints, so a song is never committed without its rows
 
-	entry = 0
-	for i in range(len(songList)):
-		song = Song(songList[i], directory + songList[i])
-		for j in range(len(song.analyzer())):
-			signList = song.analyzer()[j].tolist()
-			cur.execute(insert_signature_query, (entry, i, signList))
-			entry += 1
+	the store is appended to before the commit, and cut back to its length if
+	the commit fails, so its rows stay in step with the entry_ids
 
-	conn.commit()
-	conn.close()
-	return True
+	params:
+		conn: an open connection
+		song_rows: the (id, title) of every song
+		signature_rows, fingerprint_rows: the rows of the songs, as for copy_rows
+		stored: the (song_id, signature matrix) of every song with signatures
+		store: a SignatureStore the signatures are appended to, None for none
+
+	"""
+	cur = conn.cursor()
+	copy_rows(cur, 'songs', ('id', 'title'), song_rows)
+	if signature_rows:
+		copy_rows(cur, 'signatures', SIGNATURE_COLUMNS, signature_rows)
+	if fingerprint_rows:
+		copy_rows(cur, 'fingerprints', FINGERPRINT_COLUMNS, fingerprint_rows)
+
+	size = len(store) if store is not None else 0
+	try:
+		if store is not None:
+			for song_id, song_signatures in stored:
+				store.append(song_signatures, [song_id] * len(song_signatures),
+							 np.arange(len(song_signatures)))
+		conn.commit()
+	except BaseException:
+		if store is not None:
+			store.truncate(size)
+		raise
+
+
+def next_ids(cur):
+	"""
+	get the next free song_id and entry_id, following the existing rows
+
+	params:
+		cur: the cursor of an open connection
+
+	returns:
+		the next song_id and the next entry_id, both 0 for an empty library
+
+	"""
+	cur.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM songs;")
+	song_id = cur.fetchone()[0]
+	cur.execute("SELECT COALESCE(MAX(entry_id) + 1, 0) FROM signatures;")
+	entry_id = cur.fetchone()[0]
+	return song_id, entry_id
 
 
-def get_song_info(song_id):
+def get_song_info(song_id, pool = None):
 	"""
 	get all information about the song
 
 	params:
 		song_id: the unique id that identifies one song in the database
+		pool: a ConnectionPool to borrow the connection from, None to open one
 
 	returns:
 		rst: the information corresponding to the song_id, including song_id, title
 
 	"""
-	conn = Database().conn
-	cur = conn.cursor()
-	cur.execute("SELECT * FROM songs WHERE id = %s;", (song_id,))
-	rst = cur.fetchone()
-	conn.close()
+	with connection(pool) as conn:
+		cur = conn.cursor()
+		cur.execute("SELECT * FROM songs WHERE id = %s;", (song_id,))
+		rst = cur.fetchone()
 	return rst
 
 
-def get_song_signature(entry_id):
+def get_song_signature(entry_id, pool = None):
 	"""
 	get a list of signatures for one song in the database
 
 	params:
 		entry_id: the entry_id returned by the 'search_nearest' matching process
+		pool: a ConnectionPool to borrow the connection from, None to open one
 
 	returns:
-		rst: the song_id and signature corresponding to the entry_id
+		rst: the song_id and signature (a float32 array) corresponding to the entry_id
 
 	"""
-	conn = Database().conn
-	cur = conn.cursor()
+	with connection(pool) as conn:
+		cur = conn.cursor()
+		cur.execute("SELECT song_id, signature FROM signatures WHERE entry_id = %s;", (entry_id,))
+		rst = cur.fetchone()
 
-	cur.execute("SELECT song_id, signature FROM signatures WHERE entry_id = %s;", (entry_id,))
-	rst = cur.fetchone()
-	conn.close()
-	return rst
+	if rst is None:
+		return None
+	return rst[0], decode_signature(rst[1])
+
+
+def get_songs_info(song_ids, pool = None):
+	"""
+	get the information about many songs with a single query
+
+	params:
+		song_ids: a list of song_ids
+		pool: a ConnectionPool to borrow the connection from, None to open one
+
+	returns:
+		rst: a dict from each song_id found to its (song_id, title)
+
+	"""
+	with connection(pool) as conn:
+		cur = conn.cursor()
+		cur.execute("SELECT * FROM songs WHERE id = ANY(%s);", (list(set(song_ids)),))
+		rows = cur.fetchall()
+	return {row[0]: row for row in rows}
 
 
-def get_all_signatures():
+def get_signatures(entry_ids, pool = None):
+	"""
+	get the song_ids and signatures of many entries with a single query
+
+	params:
+		entry_ids: a list of entry_ids returned by the 'search_nearest' matching process
+		pool: a ConnectionPool to borrow the connection from, None to open one
+
+	returns:
+		rst: a dict from each entry_id found to its song_id and signature (a float32 array)
+
+	"""
+	with connection(pool) as conn:
+		cur = conn.cursor()
+		cur.execute("SELECT entry_id, song_id, signature FROM signatures WHERE entry_id = ANY(%s);",
+					(list(set(entry_ids)),))
+		rows = cur.fetchall()
+	return {row[0]: (row[1], decode_signature(row[2])) for row in rows}
+
+
+def get_all_signatures(pool = None, start = 0):
 	"""
 	get all signatures in the database, for building a hashtable
 
+	params:
+		pool: a ConnectionPool to borrow the connection from, None to open one
+		start: the first entry_id returned, to read only newly added signatures
+
 	returns:
 		all_signatures: an array of all signatures in the database
 
 	"""
-	conn = Database().conn
-	cur = conn.cursor()
-	cur.execute("SELECT signature FROM signatures;")
-	signatures_list = cur.fetchall()
-
-	all_signatures = []
-	for one in signatures_list:
-		one = (re.sub('[{}]','',one[0])).split(',')
-		one = [float(x) for x in one]
-		all_signatures.append(one)
-
-	# Cast the data for hashing to numpy.float32 to improve performance
-	all_signatures = np.asarray(all_signatures, dtype=np.float32)
-	
-	conn.close()
+	with connection(pool) as conn:
+		cur = conn.cursor()
+		cur.execute("SELECT signature FROM signatures WHERE entry_id >= %s ORDER BY entry_id;",
+					(start,))
+		signatures_list = cur.fetchall()
+
+	# copy the packed float32 bytes straight into one writable matrix
+	width = len(signatures_list[0][0]) // np.dtype(np.float32).itemsize if signatures_list else 0
+	all_signatures = np.empty((len(signatures_list), width), dtype=np.float32)
+	for i, one in enumerate(signatures_list):
+		all_signatures[i] = decode_signature(one[0])
+
 	return all_signatures
 
 
-def get_all_songs():
+def get_entry_song_ids(pool = None, start = 0):
+	"""
+	get the song_id of every signature, in the same order as get_all_signatures
+
+	params:
+		pool: a ConnectionPool to borrow the connection from, None to open one
+		start: the first entry_id returned, to read only newly added signatures
+
+	returns:
+		song_ids: an integer array, the song_id of each entry
+
+	"""
+	with connection(pool) as conn:
+		cur = conn.cursor()
+		cur.execute("SELECT song_id FROM signatures WHERE entry_id >= %s ORDER BY entry_id;",
+					(start,))
+		rows = cur.fetchall()
+	return np.asarray([row[0] for row in rows], dtype=np.int64)
+
+
+def get_entry_offsets(pool = None, start = 0):
+	"""
+	get the window offset of every signature, in the same order as get_all_signatures
+
+	params:
+		pool: a ConnectionPool to borrow the connection from, None to open one
+		start: the first entry_id returned, to read only newly added signatures
+
+	returns:
+		offsets: an integer array, the index of each entry's window in its song
+
+	"""
+	with connection(pool) as conn:
+		cur = conn.cursor()
+		cur.execute("SELECT window_offset FROM signatures WHERE entry_id >= %s ORDER BY entry_id;",
+					(start,))
+		rows = cur.fetchall()
+	return np.asarray([row[0] for row in rows], dtype=np.int64)
+
+
+def get_fingerprints(pool = None, start = 0):
+	"""
+	get the fingerprints of all songs, for building a FingerprintIndex
+
+	params:
+		pool: a ConnectionPool to borrow the connection from, None to open one
+		start: the first song_id returned, to read only newly added songs
+
+	returns:
+		hashes: a uint32 array of the peak-pair hashes
+		song_ids: the song of every hash
+		times: the spectrogram frame of every hash in its song
+
+	"""
+	with connection(pool) as conn:
+		cur = conn.cursor()
+		cur.execute("SELECT hash, song_id, time_offset FROM fingerprints WHERE song_id >= %s;",
+					(start,))
+		rows = cur.fetchall()
+
+	rows = np.asarray(rows, dtype=np.int64).reshape(-1, 3)
+	hashes = rows[:, 0].astype(np.int32).view(np.uint32)
+	return hashes, rows[:, 1], rows[:, 2].astype(np.int32)
+
+
+def get_all_songs(pool = None):
 	"""
 	get a list of all songs in the database
 
+	params:
+		pool: a ConnectionPool to borrow the connection from, None to open one
+
 	returns:
 		rst: a list of all songs
 	"""
-	conn = Database().conn
-	cur = conn.cursor()
-
-	cur.execute("SELECT * FROM songs;")
-	rst = cur.fetchall()
-	conn.close()
+	with connection(pool) as conn:
+		cur = conn.cursor()
+		cur.execute("SELECT * FROM songs;")
+		rst = cur.fetchall()
 	return rst
-
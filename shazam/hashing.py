@@ -12,25 +12,106 @@ import wave as wv
 from pydub import AudioSegment
 import os
 import re
+import copy
+import json
 import random
 import struct
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.format import open_memmap
+
+# projections of signatures before LSH indexing, the seed of the random
+# projection, and the most signatures the principal components are fitted on
+PROJECTIONS = (None, 'random', 'pca')
+LSH_FAMILIES = (None, 'CrossPolytope', 'Hyperplane')
+PROJECTION_SEED = 0
+PCA_SAMPLE = 2000
+
+# the files build_store writes to a store's directory, numbered by generation
+STORE_BUILD_FILE = re.compile(r'(centered|points)\.(\d+)\.npy$')
+
+# fields of falconn.LSHConstructionParameters kept in a saved index
+PARAM_FIELDS = ('dimension', 'k', 'l', 'num_rotations', 'num_setup_threads',
+				'seed', 'last_cp_dimension', 'feature_hashing_dimension')
+ENUM_FIELDS = {'lsh_family': falconn.LSHFamily,
+			   'distance_function': falconn.DistanceFunction,
+			   'storage_hash_table': falconn.StorageHashTable}
 
 
 class Hashtable:
 	"""
 	a class that can build hash table for efficient signal searching and matching"""
 
-	def __init__(self):
+	def __init__(self, pool = None, max_delta = 5000, projection = None, dimension = 256,
+				 width = 10, shift = 1, window_type = 'hann',
+				 lsh_family = None, num_tables = None, num_probes = None, store = None):
+		"""
+		initiate an empty hash table
+
+		params:
+			pool: a ConnectionPool used to look up song titles
+			max_delta: the most added signatures searched exhaustively before a merge
+			projection: None, 'random' or 'pca', reduces signatures before indexing
+			dimension: the dimension of the projected signatures
+			width, shift, window_type: the analyzer parameters of the snippets,
+									   the same as the library's
+			lsh_family: 'CrossPolytope' or 'Hyperplane', falconn's default if None
+			num_tables: the number of hash tables, falconn's default if None
+			num_probes: the number of buckets probed per query, one per table if None
+			store: a SignatureStore the table is built from, instead of memory
+
+		"""
 		
+		if projection not in PROJECTIONS:
+			raise ValueError("The projection must be one of {}.".format(PROJECTIONS))
+		if lsh_family not in LSH_FAMILIES:
+			raise ValueError("The LSH family must be one of {}.".format(LSH_FAMILIES))
+
 		self.table = None
 		self.query_object = None
+		self.query_pool = None
+		self.params = None
+		self.pool = pool
+
+		# the centered signature matrix, its mean, and the song_id and window
+		# offset (the index of the window in its song) of every row
+		self.signatures = None
+		self.mean = None
+		self.song_ids = None
+		self.offsets = None
+
+		# centered signatures added since the LSH table was built, searched
+		# exhaustively until more than max_delta of them are merged in, and
+		# their squared norms, kept so that every search doesn't recompute them
+		self.delta = None
+		self.delta_norms = None
+		self.max_delta = max_delta
 
-	def build_lsh(self, all_signatures):
+		# an optional linear map ('random' or 'pca') of the centered signatures
+		# to the dimension the LSH table is built in, and the mapped points
+		self.method = projection
+		self.dimension = dimension
+		self.projection = None
+		self.points = None
+
+		self.analysis = dict(width = width, shift = shift, window_type = window_type)
+		self.lsh_family = lsh_family
+		self.num_tables = num_tables
+		self.num_probes = num_probes
+		self.store = store
+
+	def build_lsh(self, all_signatures, song_ids = None, offsets = None):
 		"""
 		take signatures of songs to build a LSH table, and the query object
 
+		the centered signatures, their song_ids and offsets are kept in memory,
+		so that matches can be re-ranked without reading the database
+
 		params:
 			all_signatures: all signatures from the database
+			song_ids: the song_id of every signature, read from the database
+					  (with the offsets) if None
+			offsets: the window offset of every signature, counted from the
+					 order of song_ids if None
 		
 		returns:
 			a falconn hash table;
@@ -42,24 +123,376 @@ class Hashtable:
 		if all_signatures.shape[0] == 0:
 			raise ValueError("All signatures must not be empty.")
 
-		params = falconn.get_default_parameters(all_signatures.shape[0], all_signatures.shape[1])
+		if song_ids is None:
+			song_ids = db.get_entry_song_ids(self.pool)
+			offsets = db.get_entry_offsets(self.pool)
+		if offsets is None:
+			offsets = window_offsets(song_ids)
+		if len(song_ids) != all_signatures.shape[0] or len(offsets) != len(song_ids):
+			raise ValueError("Every signature must have a song_id and an offset.")
 
 		# center the dataset to improve performance: 
-		all_signatures -= np.mean(all_signatures, axis=0)
+		mean = np.mean(all_signatures, axis=0)
+		all_signatures -= mean
+
+		self.signatures = all_signatures
+		self.mean = mean
+		self.song_ids = np.asarray(song_ids)
+		self.offsets = np.asarray(offsets)
+		self.delta = np.empty((0, all_signatures.shape[1]), dtype=np.float32)
+		self.delta_norms = np.empty(0, dtype=np.float32)
+
+		self.build_table()
+
+		if not self.table or not self.query_object:
+			return None
+
+
+	def build_store(self, store, block = 4096):
+		"""
+		take the signatures of a SignatureStore to build a LSH table, without
+		ever holding all of them in memory
+
+		the mean is accumulated block by block, and the centered signatures (and
+		any projected points) are written block by block to memory-mapped files
+		in the store's directory, which the table then indexes directly; every
+		build writes files of a new generation, so the files mapped by the
+		current table are never overwritten, and removes the earlier ones once
+		the new table has replaced it
+
+		params:
+			store: a SignatureStore holding every signature of the library
+			block: the number of signatures processed at once
+
+		"""
+
+		source = store.signatures()
+		if len(source) == 0:
+			raise ValueError("All signatures must not be empty.")
+
+		total = np.zeros(source.shape[1], dtype=np.float64)
+		for i in range(0, len(source), block):
+			total += np.sum(source[i: i + block], axis=0, dtype=np.float64)
+		mean = (total / len(source)).astype(np.float32)
+
+		builds = {}
+		for name in os.listdir(store.path):
+			match = STORE_BUILD_FILE.match(name)
+			if match:
+				builds[name] = int(match.group(2))
+		generation = max(builds.values(), default = -1) + 1
+
+		centered = write_blocks(os.path.join(store.path, 'centered.{}.npy'.format(generation)),
+								source.shape, block, lambda rows: source[rows] - mean)
+
+		# the new table is built on a copy, so queries keep the current one
+		# until it is complete
+		built = copy.copy(self)
+		built.signatures = centered
+		built.mean = mean
+		built.song_ids = store.song_ids()
+		built.offsets = store.offsets()
+		built.delta = np.empty((0, source.shape[1]), dtype=np.float32)
+		built.delta_norms = np.empty(0, dtype=np.float32)
+		built.store = store
+		built.build_table(os.path.join(store.path, 'points.{}.npy'.format(generation)), block)
+		self.__dict__.update(built.__dict__)
+
+		# files of earlier builds are no longer mapped by the new table
+		for name in builds:
+			os.remove(os.path.join(store.path, name))
+
+
+	def build_table(self, points_path = None, block = 4096):
+		"""
+		project the centered signatures if asked, and build the LSH table over them
+
+		params:
+			points_path: a '.npy' file the projected points are written to block
+						 by block, None to hold them in memory
+			block: the number of signatures projected at once
+
+		"""
+
+		# the LSH table indexes the projected signatures, re-ranking uses the full ones
+		if self.method is None:
+			self.points = self.signatures
+		else:
+			self.projection = fit_projection(self.signatures, self.method, self.dimension)
+			if points_path is None:
+				self.points = self.signatures.dot(self.projection)
+			else:
+				shape = (len(self.signatures), self.dimension)
+				project = lambda rows: self.signatures[rows].dot(self.projection)
+				self.points = write_blocks(points_path, shape, block, project)
+
+		params = falconn.get_default_parameters(self.points.shape[0], self.points.shape[1])
+		if self.lsh_family is not None:
+			params.lsh_family = getattr(falconn.LSHFamily, self.lsh_family)
+			num_hash_bits = max(1, int(np.floor(np.log2(self.points.shape[0]))))
+			falconn.compute_number_of_hash_functions(num_hash_bits, params)
+		if self.num_tables is not None:
+			params.l = self.num_tables
+
+		self.setup_table(params)
+
+
+	def setup_table(self, params):
+		"""
+		construct the falconn LSH table and query object over self.points
+
+		params:
+			params: the falconn.LSHConstructionParameters of the table
+
+		"""
 
 		# Create the LSH table
 		print('Constructing the LSH table...')		
 		table = falconn.LSHIndex(params)
-		table.setup(all_signatures)
+		table.setup(self.points)
+
+		# falconn probes one bucket per table when num_probes is -1
+		num_probes = -1 if self.num_probes is None else self.num_probes
 
 		print('Constructing the queries...')		
-		query_object = table.construct_query_object()
+		query_object = table.construct_query_object(num_probes)
 
+		self.params = params
 		self.table = table
 		self.query_object = query_object
-		
-		if not table or not query_object:
-			return None
+
+		# a thread-safe pool of query objects, for batches of windows
+		self.query_pool = table.construct_query_pool(num_probes)
+
+
+	def set_num_probes(self, num_probes):
+		"""
+		set the number of buckets probed per query, at least one per table
+
+		params:
+			num_probes: the number of probes, trading speed for recall
+
+		"""
+
+		if num_probes < self.params.l:
+			raise ValueError("The number of probes must be at least the number of tables.")
+
+		self.num_probes = num_probes
+		self.query_object.set_num_probes(num_probes)
+		self.query_pool.set_num_probes(num_probes)
+
+
+	def tune_probes(self, snippet_paths, target_recall = 0.9, max_probes = 4096, threads = 1):
+		"""
+		pick the fewest probes whose recall on held-out snippets hits the target
+
+		the recall is the fraction of snippet windows whose nearest entry found
+		with LSH is the exact nearest entry, found by exhaustive search
+
+		params:
+			snippet_paths: a list of held-out snippet paths ending with '.wav'
+			target_recall: the recall to reach, between 0 and 1
+			max_probes: the most probes tried
+			threads: the number of threads analyzing snippets and querying windows
+
+		returns:
+			num_probes: the number of probes picked, and now used
+			recall: the recall measured with num_probes
+
+		"""
+
+		windows = np.vstack([self.analyze_snippet(path) for path in snippet_paths]) - self.mean
+		exact_ids, _ = self.exact_windows(windows)
+
+		def recall(num_probes):
+			self.set_num_probes(num_probes)
+			entry_ids, distances = self.query_windows(windows, 1, threads)
+			# a window without any candidate found nothing, whatever its entry_id reads
+			return float(np.mean((entry_ids == exact_ids) & np.isfinite(distances)))
+
+		# double the probes until the target is hit, then bisect for the fewest
+		low, high = self.params.l, self.params.l
+		high_recall = recall(high)
+		while high_recall < target_recall and high < max_probes:
+			low, high = high, min(2 * high, max_probes)
+			high_recall = recall(high)
+
+		while low < high - 1 and high_recall >= target_recall:
+			middle = (low + high) // 2
+			middle_recall = recall(middle)
+			if middle_recall >= target_recall:
+				high, high_recall = middle, middle_recall
+			else:
+				low = middle
+
+		self.set_num_probes(high)
+		return high, high_recall
+
+
+	def exact_windows(self, windows, block = 256, row_block = 4096):
+		"""
+		find the exact nearest entry of every window by exhaustive search
+
+		the indexed signatures and the delta are searched in place, row_block
+		rows at a time, so a memory-mapped library is never read in whole, and
+		every block of rows is read and squared only once
+
+		params:
+			windows: a matrix of centered signature windows, one per row
+			block: the number of windows compared at once
+			row_block: the number of signatures compared at once
+
+		returns:
+			entry_ids: the entry of the nearest signature of every window
+			distances: the squared euclidean distance to that signature
+
+		"""
+
+		entry_ids = np.zeros(len(windows), dtype=np.int64)
+		distances = np.full(len(windows), np.inf, dtype=np.float32)
+
+		start = 0
+		for rows, norms in ((self.signatures, None), (self.delta, self.delta_norms)):
+			for j in range(0, len(rows), row_block):
+				part = np.asarray(rows[j: j + row_block])
+				part_norms = np.sum(part**2, axis=1) if norms is None else norms[j: j + row_block]
+
+				for i in range(0, len(windows), block):
+					ids, dists = nearest_rows(windows[i: i + block], part, part_norms)
+					closer = dists < distances[i: i + block]
+					entry_ids[i: i + block][closer] = start + j + ids[closer]
+					distances[i: i + block][closer] = dists[closer]
+			start += len(rows)
+
+		return entry_ids, distances
+
+
+	def add(self, signatures, song_ids, offsets = None):
+		"""
+		add new signatures to the index without rebuilding the LSH table
+
+		the signatures go to the delta, which is merged into the LSH table
+		once it holds more than max_delta signatures; their entries follow
+		the existing ones, in order
+
+		params:
+			signatures: a matrix of the new signatures
+			song_ids: the song_id of every new signature
+			offsets: the window offset of every new signature, counted from
+					 the order of song_ids if None
+
+		"""
+
+		if offsets is None:
+			offsets = window_offsets(song_ids)
+		if len(song_ids) != len(signatures) or len(offsets) != len(song_ids):
+			raise ValueError("Every signature must have a song_id and an offset.")
+		if len(signatures) == 0:
+			return
+
+		if self.table is None and self.store is not None:
+			self.build_store(self.store)
+			return
+		if self.table is None:
+			self.build_lsh(np.array(signatures, dtype=np.float32), song_ids, offsets)
+			return
+
+		signatures = np.asarray(signatures, dtype=np.float32) - self.mean
+		self.delta = np.vstack([self.delta, signatures])
+		self.delta_norms = np.concatenate([self.delta_norms, np.sum(signatures**2, axis=1)])
+		self.song_ids = np.concatenate([self.song_ids, song_ids])
+		self.offsets = np.concatenate([self.offsets, offsets])
+
+		if len(self.delta) > self.max_delta:
+			self.merge()
+
+
+	def merge(self):
+		"""
+		rebuild the LSH table over the indexed and the delta signatures"""
+
+		# a store already holds the delta, which was appended to it at ingest
+		if self.store is not None:
+			self.build_store(self.store)
+			return
+
+		all_signatures = np.vstack([self.signatures, self.delta]) + self.mean
+		self.build_lsh(all_signatures, self.song_ids, self.offsets)
+
+
+	def save(self, path):
+		"""
+		save the index to a directory, so a new process can warm start with load
+
+		the signature matrix, the centering mean, the song_ids and offsets,
+		the delta and any projection are saved as '.npy' files, and the LSH
+		parameters (including the seed) as json
+
+		params:
+			path: a directory, created if it doesn't exist
+
+		"""
+
+		if self.table is None:
+			raise ValueError("The LSH table must be built before saving.")
+
+		os.makedirs(path, exist_ok=True)
+		np.save(os.path.join(path, 'signatures.npy'), self.signatures)
+		np.save(os.path.join(path, 'mean.npy'), self.mean)
+		np.save(os.path.join(path, 'song_ids.npy'), self.song_ids)
+		np.save(os.path.join(path, 'offsets.npy'), self.offsets)
+		np.save(os.path.join(path, 'delta.npy'), self.delta)
+		if self.projection is not None:
+			np.save(os.path.join(path, 'projection.npy'), self.projection)
+			np.save(os.path.join(path, 'points.npy'), self.points)
+
+		with open(os.path.join(path, 'params.json'), 'w') as f:
+			json.dump(dict(params_to_dict(self.params), projection=self.method,
+						   num_probes=self.num_probes, analysis=self.analysis), f)
+
+
+	@classmethod
+	def load(cls, path, pool = None, mmap = True):
+		"""
+		load an index saved by save, without reading or re-analyzing any song
+
+		params:
+			path: the directory the index was saved to
+			pool: a ConnectionPool used to look up song titles
+			mmap: memory-map the signature matrix instead of reading it in
+
+		returns:
+			a Hashtable, ready for search_nearest
+
+		"""
+
+		hashtable = cls(pool)
+		hashtable.signatures = np.load(os.path.join(path, 'signatures.npy'),
+									   mmap_mode='r' if mmap else None)
+		hashtable.mean = np.load(os.path.join(path, 'mean.npy'))
+		hashtable.song_ids = np.load(os.path.join(path, 'song_ids.npy'))
+		hashtable.offsets = np.load(os.path.join(path, 'offsets.npy'))
+		hashtable.delta = np.load(os.path.join(path, 'delta.npy'))
+		hashtable.delta_norms = np.sum(hashtable.delta**2, axis=1)
+
+		with open(os.path.join(path, 'params.json')) as f:
+			params = json.load(f)
+
+		hashtable.method = params.get('projection')
+		hashtable.num_probes = params.get('num_probes')
+		hashtable.analysis = params.get('analysis', hashtable.analysis)
+		hashtable.lsh_family = params['lsh_family']
+		hashtable.num_tables = params['l']
+		hashtable.points = hashtable.signatures
+		if hashtable.method is not None:
+			hashtable.projection = np.load(os.path.join(path, 'projection.npy'))
+			hashtable.points = np.load(os.path.join(path, 'points.npy'),
+									   mmap_mode='r' if mmap else None)
+			hashtable.dimension = hashtable.projection.shape[1]
+
+		hashtable.setup_table(params_from_dict(params))
+
+		return hashtable
 
 
 	def search_nearest(self, snippet_path, K, threshold):
@@ -78,41 +511,515 @@ class Hashtable:
 
 		"""
 
-		query_object = self.query_object
+		return self.search_many([snippet_path], K, threshold)[0]
+
+
+	def search_many(self, snippet_paths, K, threshold, threads = 1):
+		"""
+		search for the K nearest songs of many snippets at once
+
+		the snippets are analyzed concurrently, the windows of all snippets are
+		queried together as one batch, and the titles of all matches are read
+		with a single query
+
+		params:
+			snippet_paths: a list of snippet paths ending with '.wav'
+			K: the number of song(s) that match(es) each snippet
+			threshold: the min distance should be no larger than the threshold
+			threads: the number of threads analyzing snippets and querying windows
+
+		returns:
+			a list with the result of search_nearest for every snippet
+
+		"""
+
+		return self.search_signatures(self.analyze_snippets(snippet_paths, threads), K, threshold, threads)
+
+
+	def search_signatures(self, snippet_signatures, K, threshold, threads = 1):
+		"""
+		search for the K nearest songs of many snippets already analyzed, as search_many
+
+		params:
+			snippet_signatures: a list with the signature matrix of every snippet
+			K: the number of song(s) that match(es) each snippet
+			threshold: the min distance should be no larger than the threshold
+			threads: the number of threads querying windows
+
+		returns:
+			a list with the result of search_nearest for every snippet
+
+		"""
+
+		songs_ids, _, distances = self.query_signatures(snippet_signatures, K, threads)
+
+		# keep the K nearest windows of each snippet
+		matches = []
+		for songs_id, snippet_distances in zip(songs_ids, distances):
+			k_min_distances_idx = snippet_distances.argsort()[:K]
+			k_min_distances = snippet_distances[k_min_distances_idx]
+
+			if len(k_min_distances) == 0 or min(k_min_distances) > threshold:
+				print("The snippet doesn't match any song in our library!")
+				matches.append(None)
+			else:
+				k_min_songs_id = [int(songs_id[i]) for i in k_min_distances_idx]
+				matches.append((k_min_songs_id, k_min_distances))
+
+		# the database is only consulted for the titles
+		all_songs_id = [song_id for match in matches if match for song_id in match[0]]
+		songs_info = db.get_songs_info(all_songs_id, self.pool) if all_songs_id else {}
+
+		results = []
+		for match in matches:
+			if match is None:
+				results.append(None)
+			else:
+				k_min_songs_id, k_min_distances = match
+				results.append(([songs_info[song_id] for song_id in k_min_songs_id], k_min_distances))
+
+		return results
+
+
+	def search_aligned(self, snippet_paths, K, threshold, min_votes = 2, threads = 1):
+		"""
+		search for the K songs that the most windows of each snippet agree on,
+		at the same time alignment
+
+		every window whose nearest signature is within threshold votes for
+		that signature's song, at the window offset where the snippet would
+		start in the song; a song scores the votes of its best offset
+
+		params:
+			snippet_paths: a list of snippet paths ending with '.wav'
+			K: the number of song(s) returned for each snippet
+			threshold: the max distance of a window that votes
+			min_votes: the fewest votes of a song matched
+			threads: the number of threads analyzing snippets and querying windows
+
+		returns:
+			a list with, for every snippet, up to K tuples of the (song_id, title),
+			the votes and the offset of a song, with the most votes first;
+			None if no song has min_votes
+
+		"""
+
+		songs_ids, offsets, distances = self.query_snippets(snippet_paths, 1, threads)
+
+		matches = []
+		for songs_id, snippet_offsets, snippet_distances in zip(songs_ids, offsets, distances):
+			ranked = vote_offsets(songs_id, snippet_offsets, snippet_distances, threshold)
+			ranked = [match for match in ranked if match[1] >= min_votes][:K]
+
+			if len(ranked) == 0:
+				print("The snippet doesn't match any song in our library!")
+			matches.append(ranked or None)
+
+		# the database is only consulted for the titles
+		all_songs_id = [match[0] for ranked in matches if ranked for match in ranked]
+		songs_info = db.get_songs_info(all_songs_id, self.pool) if all_songs_id else {}
+
+		return [None if ranked is None else
+				[(songs_info[song_id], votes, offset) for song_id, votes, offset in ranked]
+				for ranked in matches]
+
+
+	def analyze_snippet(self, snippet_path):
+		"""
+		analyze a snippet with the same parameters as the library"""
 
 		snippet = Song('snippet', snippet_path)
-		snippet_signature = snippet.analyzer()
-		snippet_signature = np.asarray(snippet_signature, dtype=np.float32)
+		return np.asarray(snippet.analyzer(**self.analysis), dtype=np.float32)
+
+
+	def query_snippets(self, snippet_paths, K, threads = 1):
+		"""
+		analyze snippets concurrently, and query the windows of all of them as one batch
+
+		params:
+			snippet_paths: a list of snippet paths ending with '.wav'
+			K: the number of neighbors asked from the LSH table for every window
+			threads: the number of threads analyzing snippets and querying windows
+
+		returns:
+			songs_id: for every snippet, the song of the nearest entry of each of its windows
+			offsets: for every snippet, the window offset of each of those entries
+			distances: for every snippet, the distance of each of its windows
+
+		"""
+
+		return self.query_signatures(self.analyze_snippets(snippet_paths, threads), K, threads)
+
+
+	def analyze_snippets(self, snippet_paths, threads = 1):
+		"""
+		analyze snippets concurrently, with the same parameters as the library"""
+
+		if threads > 1:
+			with ThreadPoolExecutor(threads) as executor:
+				return list(executor.map(self.analyze_snippet, snippet_paths))
+		return [self.analyze_snippet(path) for path in snippet_paths]
+
+
+	def query_signatures(self, snippet_signatures, K, threads = 1):
+		"""
+		query the windows of analyzed snippets as one batch, as query_snippets"""
+
+		songs_id, offsets, distances = self.match_windows(np.vstack(snippet_signatures), K, threads)
+
+		# split the batch back into snippets
+		bounds = np.cumsum([len(x) for x in snippet_signatures])[:-1]
+		return np.split(songs_id, bounds), np.split(offsets, bounds), np.split(distances, bounds)
+
+
+	def match_windows(self, windows, K, threads = 1):
+		"""
+		find the song and window offset of the nearest indexed entry of every window
+
+		params:
+			windows: a matrix of signature windows, one per row, as analyzed
+			K: the number of neighbors asked from the LSH table for every window
+			threads: the number of threads sharing the LSH query pool
+
+		returns:
+			songs_id: the song of the nearest signature of every window
+			offsets: the window offset of that signature in its song
+			distances: the squared euclidean distance to that signature
+
+		"""
+
+		# queries live in the same centered space as the indexed signatures
+		entry_ids, distances = self.query_windows(windows - self.mean, K, threads)
+		return self.song_ids[entry_ids], self.offsets[entry_ids], distances
+
+
+	def indexed(self):
+		"""
+		whether any signature can be searched"""
+
+		return self.table is not None and self.query_object is not None
+
+
+	def entries(self):
+		"""
+		the number of entries indexed, which is the entry_id of the next one added"""
+
+		return 0 if self.song_ids is None else len(self.song_ids)
+
+
+	def query_windows(self, windows, K, threads = 1):
+		"""
+		find the nearest indexed entry of every window, in the LSH table and the delta
+
+		params:
+			windows: a matrix of centered signature windows, one per row
+			K: the number of neighbors asked from the LSH table for every window
+			threads: the number of threads sharing the LSH query pool
+
+		returns:
+			entry_ids: the entry of the nearest signature of every window, 0 for
+					   a window without any candidate
+			distances: the squared euclidean distance to that signature, inf for
+					   a window without any candidate
+
+		"""
 
-		k_nearest = []
-		for line in snippet_signature:
-			k_nearest.append(query_object.find_k_nearest_neighbors(line, K))
+		points = windows if self.projection is None else windows.dot(self.projection)
 
-		distances = []
-		matched_songs_id = []
+		if threads > 1:
+			query = lambda line: self.query_pool.find_k_nearest_neighbors(line, K)
+			with ThreadPoolExecutor(threads) as executor:
+				k_nearest = list(executor.map(query, points))
+		else:
+			k_nearest = [self.query_object.find_k_nearest_neighbors(line, K) for line in points]
 
-		for i, value in enumerate(k_nearest):
-			entry_id = value[0]
-			matched_songs_id.append(db.get_song_signature(entry_id)[0])
+		# re-rank the candidates of every window in memory, in the full dimension
+		entry_ids = np.zeros(len(windows), dtype=np.int64)
+		distances = np.full(len(windows), np.inf, dtype=np.float32)
+
+		for i, candidates in enumerate(k_nearest):
+			if len(candidates) == 0:
+				continue
+			candidates = np.asarray(candidates, dtype=np.int64)
+			diffs = windows[i] - self.signatures[candidates]
+			candidate_distances = np.einsum('ij,ij->i', diffs, diffs)
+
+			nearest = np.argmin(candidate_distances)
+			entry_ids[i] = candidates[nearest]
+			distances[i] = candidate_distances[nearest]
+
+		# recently added signatures are searched exhaustively in the delta
+		if len(self.delta):
+			delta_ids, delta_distances = nearest_rows(windows, self.delta, self.delta_norms)
+			closer = delta_distances < distances
+			entry_ids = np.where(closer, len(self.signatures) + delta_ids, entry_ids)
+			distances = np.where(closer, delta_distances, distances)
+
+		return entry_ids, distances
+
+
+def write_blocks(path, shape, block, compute):
+	"""
+	write a float32 '.npy' matrix block by block, and map it back read-only
+
+	params:
+		path: the '.npy' file written
+		shape: the shape of the matrix
+		block: the number of rows computed at once
+		compute: a function from a slice of rows to their values
+
+	returns:
+		the matrix, memory-mapped read-only
+
+	"""
+
+	matrix = open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+	for i in range(0, shape[0], block):
+		rows = slice(i, min(i + block, shape[0]))
+		matrix[rows] = compute(rows)
+	matrix.flush()
+	del matrix
+
+	return np.load(path, mmap_mode='r')
+
+
+def fit_projection(signatures, method, dimension, sample = PCA_SAMPLE):
+	"""
+	fit a linear map of centered signatures to a lower dimension
+
+	params:
+		signatures: a matrix of centered signatures, one per row
+		method: 'random' for a gaussian random projection, 'pca' for the
+				principal components of (a sample of) the signatures
+		dimension: the dimension signatures are mapped to
+		sample: the most signatures the principal components are fitted on
+
+	returns:
+		projection: a float32 matrix of shape (signatures.shape[1], dimension)
+
+	"""
 
-			signature_string = db.get_song_signature(entry_id)[1]
-			matched_signature = (re.sub('[{}]','',signature_string)).split(',')
-			matched_signature = [float(x) for x in matched_signature]
-			matched_signature = np.asarray(matched_signature, dtype=np.float32)
+	width = signatures.shape[1]
+	if not 0 < dimension <= width:
+		raise ValueError("The dimension must be between 1 and {}.".format(width))
 
-			distances.append(np.sum(snippet_signature[i] - matched_signature)**2)
+	rng = np.random.default_rng(PROJECTION_SEED)
 
-		distances = np.asarray(distances)
-		k_min_distances_idx = distances.argsort()[:K]
-		k_min_distances = distances[k_min_distances_idx]
+	if method == 'random':
+		projection = rng.standard_normal((width, dimension)) / np.sqrt(dimension)
+		return projection.astype(np.float32)
 
-		if min(k_min_distances) > threshold:
+	if len(signatures) > sample:
+		signatures = signatures[np.sort(rng.choice(len(signatures), sample, replace=False))]
+	_, _, components = np.linalg.svd(signatures, full_matrices=False)
+
+	# fewer signatures than dimensions leave the extra components at zero
+	projection = np.zeros((width, dimension), dtype=np.float32)
+	projection[:, :min(dimension, len(components))] = components[:dimension].T
+	return projection
+
+
+def nearest_rows(queries, rows, norms = None):
+	"""
+	find the nearest row to every query by exhaustive search
+
+	params:
+		queries: a matrix with one query per row
+		rows: a matrix of the rows searched
+		norms: the squared euclidean norm of every row, computed if None
+
+	returns:
+		nearest: the index of the nearest row for every query
+		distances: the squared euclidean distance to that row
+
+	"""
+
+	# rank with the expanded form, then recompute the winners exactly
+	if norms is None:
+		norms = np.sum(rows**2, axis=1)
+	scores = norms - 2 * queries.dot(rows.T)
+	nearest = np.argmin(scores, axis=1)
+
+	diffs = queries - rows[nearest]
+	return nearest, np.einsum('ij,ij->i', diffs, diffs)
+
+
+class FingerprintIndex:
+	"""
+	an inverted index from peak-pair hashes to the songs and times they occur at,
+	an alternative to the LSH table that matches with integer lookups"""
+
+	def __init__(self, pool = None):
+
+		# postings sorted by hash, so a hash's postings are one contiguous range
+		self.hashes = np.empty(0, dtype=np.uint32)
+		self.song_ids = np.empty(0, dtype=np.int64)
+		self.times = np.empty(0, dtype=np.int32)
+		self.pool = pool
+
+	def add(self, hashes, song_ids, times):
+		"""
+		add the fingerprints of songs to the index
+
+		params:
+			hashes: the peak-pair hashes
+			song_ids: the song of every hash
+			times: the spectrogram frame of every hash in its song
+
+		"""
+
+		if not len(hashes) == len(song_ids) == len(times):
+			raise ValueError("Every hash must have a song_id and a time.")
+
+		hashes = np.concatenate([self.hashes, np.asarray(hashes, dtype=np.uint32)])
+		order = np.argsort(hashes, kind='stable')
+
+		self.hashes = hashes[order]
+		self.song_ids = np.concatenate([self.song_ids, song_ids])[order]
+		self.times = np.concatenate([self.times, times])[order].astype(np.int32)
+
+	def next_song(self):
+		"""
+		the song_id after the last song indexed, where newly added songs start"""
+
+		return int(np.max(self.song_ids)) + 1 if len(self.song_ids) else 0
+
+	def match(self, hashes, times):
+		"""
+		rank songs by the hashes they share with a snippet at one time offset
+
+		params:
+			hashes: the peak-pair hashes of the snippet
+			times: the spectrogram frame of every hash in the snippet
+
+		returns:
+			ranked: a list of (song_id, votes, offset) with the most votes first,
+					where offset is the frame of the song the snippet starts at
+
+		"""
+
+		lo = np.searchsorted(self.hashes, hashes, side='left')
+		hi = np.searchsorted(self.hashes, hashes, side='right')
+		counts = hi - lo
+
+		# expand every snippet hash into the postings of its range
+		query = np.repeat(np.arange(len(hashes)), counts)
+		postings = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + lo[query]
+
+		alignment = self.times[postings].astype(np.int64) - np.asarray(times, dtype=np.int64)[query]
+		return best_alignments(self.song_ids[postings], alignment)
+
+	def search(self, snippet_path, K, min_votes = 5):
+		"""
+		search for the K songs sharing the most fingerprints with the snippet
+
+		params:
+			snippet_path: the snippet path ending with '.wav'
+			K: the number of song(s) returned
+			min_votes: the fewest aligned hashes of a song matched
+
+		returns:
+			a list of up to K tuples of the (song_id, title), the votes and the
+			start offset (in spectrogram frames) of a song, the most votes first;
+			None if no song has min_votes
+
+		"""
+
+		hashes, times = Song('snippet', snippet_path).fingerprints()
+		ranked = [match for match in self.match(hashes, times) if match[1] >= min_votes][:K]
+
+		if len(ranked) == 0:
 			print("The snippet doesn't match any song in our library!")
 			return None
 
-		k_min_songs_info = []
+		songs_info = db.get_songs_info([match[0] for match in ranked], self.pool)
+		return [(songs_info[song_id], votes, offset) for song_id, votes, offset in ranked]
+
+
+def window_offsets(song_ids):
+	"""
+	count the window offset of every entry, for entries ordered by song and time
+
+	params:
+		song_ids: the song_id of every entry, each song's windows in order
+
+	returns:
+		offsets: the index of every entry among the entries of its song
+
+	"""
+
+	offsets = np.zeros(len(song_ids), dtype=np.int64)
+	counts = {}
+	for i, song_id in enumerate(song_ids):
+		offsets[i] = counts.get(song_id, 0)
+		counts[song_id] = offsets[i] + 1
+	return offsets
+
+
+def vote_offsets(songs_id, offsets, distances, threshold):
+	"""
+	score songs by how many snippet windows agree on the same time alignment
+
+	params:
+		songs_id: the song matched by each snippet window, in order
+		offsets: the window offset matched by each snippet window
+		distances: the distance of each snippet window to its match
+		threshold: the max distance of a window that votes
 
-		for i in k_min_distances_idx:
-			k_min_songs_info.append(db.get_song_info(matched_songs_id[i]))
+	returns:
+		ranked: a list of (song_id, votes, offset) with the most votes first,
+				where offset is the window of the song the snippet starts at
+
+	"""
+
+	keep = distances <= threshold
+	alignment = offsets[keep] - np.arange(len(songs_id))[keep]
+	return best_alignments(songs_id[keep], alignment)
+
+
+def best_alignments(songs_id, alignment):
+	"""
+	count the votes of every (song, alignment) pair, and keep the best of each song
+
+	params:
+		songs_id: the song of every vote
+		alignment: the offset of every vote
+
+	returns:
+		ranked: a list of (song_id, votes, offset) with the most votes first
+
+	"""
+
+	pairs = np.stack([songs_id, alignment], axis=1)
+	pairs, votes = np.unique(pairs, axis=0, return_counts=True)
+
+	# the best alignment of each song
+	best = {}
+	for (song_id, offset), count in zip(pairs, votes):
+		if count > best.get(song_id, (0, 0))[0]:
+			best[song_id] = (count, offset)
+
+	ranked = [(int(song_id), int(count), int(offset)) for song_id, (count, offset) in best.items()]
+	return sorted(ranked, key=lambda match: -match[1])
+
+
+def params_to_dict(params):
+	"""
+	convert falconn LSH parameters into a dict that can be saved as json"""
+
+	rst = {field: getattr(params, field) for field in PARAM_FIELDS}
+	for field in ENUM_FIELDS:
+		rst[field] = str(getattr(params, field)).split('.')[-1]
+	return rst
+
+
+def params_from_dict(rst):
+	"""
+	rebuild falconn LSH parameters from a dict made by params_to_dict"""
 
-		return k_min_songs_info, k_min_distances
+	params = falconn.LSHConstructionParameters()
+	for field in PARAM_FIELDS:
+		setattr(params, field, rst[field])
+	for field, enum in ENUM_FIELDS.items():
+		setattr(params, field, getattr(enum, rst[field]))
+	return params
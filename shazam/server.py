@@ -0,0 +1,267 @@
+# Title: Server
+# Project: Shazam
+# Author: Sijia Liu
+# Date: Dec. 2017
+
+import io
+import sys
+import json
+import asyncio
+import wave as wv
+from concurrent.futures import ThreadPoolExecutor
+from shazam import Shazam
+
+# reasons of the HTTP status codes answered
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+		  413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class IdentificationServer(object):
+	"""
+	an asyncio HTTP server identifying uploaded snippets with one loaded index
+
+	a snippet is POSTed to /identify as the bytes of a '.wav' file; snippets
+	uploaded while a batch is being searched wait in a queue, and are then
+	analyzed one by one and queried together with Hashtable.search_signatures,
+	run in an executor so the event loop keeps accepting uploads"""
+
+	def __init__(self, shazam, K = 1, threshold = 0.0001, threads = 4,
+				 max_batch = 32, batch_delay = 0.005, max_upload = 50 * 2**20):
+		"""
+		initiate a server around a Shazam object with songs inserted
+
+		params:
+			shazam: the Shazam object, whose index is shared by every request
+			K: the number of songs answered for every snippet
+			threshold: the min distance should be no larger than the threshold
+			threads: the number of threads analyzing and querying a batch
+			max_batch: the most snippets searched in one batch
+			batch_delay: seconds waited for more snippets once one is queued
+			max_upload: the most bytes of one snippet
+
+		"""
+
+		if K <= 0:
+			raise ValueError("K must be a positive integer.")
+		if threads < 1 or max_batch < 1:
+			raise ValueError("The threads and the batch size must be positive integers.")
+
+		self.shazam = shazam
+		self.K = int(K)
+		self.threshold = threshold
+		self.threads = threads
+		self.max_batch = max_batch
+		self.batch_delay = batch_delay
+		self.max_upload = max_upload
+
+		# a single thread runs the batches, which use threads of their own
+		self.executor = ThreadPoolExecutor(1)
+		self.queue = None
+		self.server = None
+		self.batcher = None
+
+		# the number of batches searched, and of snippets in them
+		self.batches = 0
+		self.snippets = 0
+
+	async def start(self, host = '127.0.0.1', port = 8000):
+		"""
+		start listening and batching, in the running event loop
+
+		params:
+			host: the address listened on
+			port: the port listened on, 0 for any free port
+
+		returns:
+			the asyncio server
+
+		"""
+
+		self.queue = asyncio.Queue()
+		self.batcher = asyncio.ensure_future(self.run_batches())
+		self.server = await asyncio.start_server(self.handle, host, port)
+		return self.server
+
+	async def stop(self):
+		"""
+		stop listening, and cancel the batches not yet started"""
+
+		self.server.close()
+		await self.server.wait_closed()
+		self.batcher.cancel()
+		self.executor.shutdown(wait = True)
+
+	async def identify(self, snippet):
+		"""
+		queue a snippet for the next batch, and wait for its match
+
+		params:
+			snippet: the bytes of a '.wav' file
+
+		returns:
+			the result of Hashtable.search_nearest for the snippet
+
+		"""
+
+		future = asyncio.get_running_loop().create_future()
+		await self.queue.put((snippet, future))
+		return await future
+
+	async def run_batches(self):
+		"""
+		take the queued snippets in batches, and search every batch at once"""
+
+		loop = asyncio.get_running_loop()
+		while True:
+			batch = [await self.queue.get()]
+			await asyncio.sleep(self.batch_delay)
+			while len(batch) < self.max_batch and not self.queue.empty():
+				batch.append(self.queue.get_nowait())
+
+			try:
+				results = await loop.run_in_executor(self.executor, self.search_batch,
+													 [snippet for snippet, _ in batch])
+			except Exception as error:
+				results = [error] * len(batch)
+
+			self.batches += 1
+			self.snippets += len(batch)
+			for (_, future), result in zip(batch, results):
+				if future.cancelled():
+					continue
+				if isinstance(result, Exception):
+					future.set_exception(result)
+				else:
+					future.set_result(result)
+
+	def search_batch(self, snippets):
+		"""
+		analyze every snippet of a batch on its own, so a snippet that can't be
+		analyzed only fails its own request, then query the others together
+
+		params:
+			snippets: the bytes of a '.wav' file for every request of the batch
+
+		returns:
+			for every snippet, its match as for search_nearest, or the error
+			raised analyzing it
+
+		"""
+
+		lsh = self.shazam.lsh
+
+		def analyze(snippet):
+			try:
+				return lsh.analyze_snippet(io.BytesIO(snippet))
+			except Exception as error:
+				return error
+
+		with ThreadPoolExecutor(self.threads) as executor:
+			results = list(executor.map(analyze, snippets))
+
+		analyzed = [i for i, result in enumerate(results) if not isinstance(result, Exception)]
+		if analyzed:
+			matches = lsh.search_signatures([results[i] for i in analyzed], self.K,
+											self.threshold, self.threads)
+			for i, match in zip(analyzed, matches):
+				results[i] = match
+
+		return results
+
+	async def handle(self, reader, writer):
+		"""
+		answer one HTTP request, then close the connection"""
+
+		try:
+			status, body = await self.respond(reader)
+		except (ValueError, asyncio.IncompleteReadError) as error:
+			status, body = 400, {'error': str(error)}
+		except Exception as error:
+			status, body = 500, {'error': str(error)}
+
+		content = json.dumps(body).encode()
+		writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n"
+					 "Content-Length: {}\r\nConnection: close\r\n\r\n"
+					 .format(status, STATUS[status], len(content)).encode() + content)
+		try:
+			await writer.drain()
+		finally:
+			writer.close()
+
+	async def respond(self, reader):
+		"""
+		read a request, and identify its snippet
+
+		returns:
+			the status code, and the body answered as json
+
+		"""
+
+		method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+		headers = {}
+		while True:
+			line = (await reader.readline()).decode('latin-1').strip()
+			if not line:
+				break
+			name, _, value = line.partition(':')
+			headers[name.strip().lower()] = value.strip()
+
+		if target.split('?')[0] != '/identify':
+			return 404, {'error': "Snippets are POSTed to /identify."}
+		if method != 'POST':
+			return 405, {'error': "Snippets are POSTed to /identify."}
+
+		length = int(headers.get('content-length', 0))
+		if length > self.max_upload:
+			return 413, {'error': "The snippet must be at most {} bytes.".format(self.max_upload)}
+		snippet = await reader.readexactly(length)
+
+		# a broken upload is refused here, instead of failing its whole batch
+		try:
+			with wv.open(io.BytesIO(snippet), 'r') as wavData:
+				if wavData.getnframes() == 0:
+					raise ValueError("The snippet must not be empty.")
+				if wavData.getsampwidth() != 2:
+					raise ValueError("The snippet must have 16-bit samples.")
+		except (wv.Error, EOFError):
+			raise ValueError("The snippet must be a '.wav' file.")
+
+		match = await self.identify(snippet)
+		if match is None:
+			return 200, {'matches': []}
+
+		songs_info, distances = match
+		return 200, {'matches': [{'song_id': int(song_id), 'title': title, 'distance': float(distance)}
+								 for (song_id, title), distance in zip(songs_info, distances)]}
+
+
+def serve(snapshot, host = '127.0.0.1', port = 8000, **options):
+	"""
+	load a saved index once, and serve identifications until interrupted
+
+	params:
+		snapshot: a directory written by Shazam.save
+		host: the address listened on
+		port: the port listened on
+		options: the parameters of IdentificationServer
+
+	"""
+
+	shazam = Shazam(snapshot = snapshot)
+	server = IdentificationServer(shazam, **options)
+
+	async def run():
+		listening = await server.start(host, port)
+		async with listening:
+			await listening.serve_forever()
+
+	try:
+		asyncio.run(run())
+	except KeyboardInterrupt:
+		pass
+	finally:
+		shazam.close()
+
+
+if __name__ == '__main__':
+	serve(sys.argv[1], port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000)
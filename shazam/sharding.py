@@ -0,0 +1,224 @@
+# Title: Sharding
+# Project: Shazam
+# Author: Sijia Liu
+# Date: Dec. 2017
+
+import numpy as np
+import multiprocessing as mp
+from hashing import Hashtable, window_offsets
+
+
+class ShardedHashtable(Hashtable):
+	"""
+	a hash table partitioned by song_id across worker processes, each holding
+	the LSH table of its own songs; queries are scattered to every shard and
+	the nearest entries they return are gathered and merged"""
+
+	def __init__(self, shards, pool = None, **options):
+		"""
+		start the worker processes, each with an empty hash table
+
+		params:
+			shards: the number of worker processes
+			pool: a ConnectionPool used to look up song titles, in this process only
+			options: the parameters of every shard's Hashtable, except pool and store
+
+		"""
+
+		if shards < 1:
+			raise ValueError("The number of shards must be a positive integer.")
+		if options.get('store') is not None:
+			raise ValueError("A sharded index can't be built from a signature store.")
+
+		Hashtable.__init__(self, pool, **options)
+
+		# one duplex pipe per worker, and the number of signatures it holds
+		self.connections = []
+		self.processes = []
+		self.sizes = [0] * shards
+
+		for _ in range(shards):
+			connection, child = mp.Pipe()
+			process = mp.Process(target = serve_shard, args = (child, options), daemon = True)
+			process.start()
+			child.close()
+			self.connections.append(connection)
+			self.processes.append(process)
+
+	def add(self, signatures, song_ids, offsets = None):
+		"""
+		add new signatures to the shards of their songs, song_id modulo the number of shards
+
+		params:
+			signatures: a matrix of the new signatures
+			song_ids: the song_id of every new signature
+			offsets: the window offset of every new signature, counted from
+					 the order of song_ids if None
+
+		"""
+
+		song_ids = np.asarray(song_ids, dtype=np.int64)
+		if offsets is None:
+			offsets = window_offsets(song_ids)
+		if len(song_ids) != len(signatures) or len(offsets) != len(song_ids):
+			raise ValueError("Every signature must have a song_id and an offset.")
+
+		signatures = np.asarray(signatures, dtype=np.float32)
+		offsets = np.asarray(offsets, dtype=np.int64)
+		shard_ids = song_ids % len(self.connections)
+
+		# the shards build their tables in parallel
+		busy = []
+		for shard, connection in enumerate(self.connections):
+			rows = shard_ids == shard
+			if np.any(rows):
+				connection.send(('add', (signatures[rows], song_ids[rows], offsets[rows])))
+				busy.append(shard)
+
+		replies = receive_all([self.connections[shard] for shard in busy])
+		for shard, size in zip(busy, replies):
+			if not isinstance(size, Exception):
+				self.sizes[shard] = size
+		raise_error(replies)
+
+	def merge(self):
+		"""
+		merge the delta of every shard into its LSH table"""
+
+		busy = [shard for shard, size in enumerate(self.sizes) if size]
+		for shard in busy:
+			self.connections[shard].send(('merge', ()))
+		raise_error(receive_all([self.connections[shard] for shard in busy]))
+
+	def match_windows(self, windows, K, threads = 1):
+		"""
+		find the song and window offset of the nearest indexed entry of every
+		window, over all shards
+
+		params:
+			windows: a matrix of signature windows, one per row, as analyzed
+			K: the number of neighbors asked from the LSH table of every shard
+			threads: the number of threads sharing the LSH query pool of every shard
+
+		returns:
+			songs_id: the song of the nearest signature of every window
+			offsets: the window offset of that signature in its song
+			distances: the squared euclidean distance to that signature
+
+		"""
+
+		windows = np.asarray(windows, dtype=np.float32)
+		busy = [shard for shard, size in enumerate(self.sizes) if size]
+
+		# scatter the windows, then gather the nearest entry of every shard;
+		# a shard centers the windows with its own mean, which leaves distances as they are
+		for shard in busy:
+			self.connections[shard].send(('match', (windows, K, threads)))
+		replies = receive_all([self.connections[shard] for shard in busy])
+		raise_error(replies)
+
+		if len(replies) == 0:
+			return (np.zeros(len(windows), dtype=np.int64), np.zeros(len(windows), dtype=np.int64),
+					np.full(len(windows), np.inf, dtype=np.float32))
+
+		songs_id, offsets, distances = [np.vstack(x) for x in zip(*replies)]
+		nearest = np.argmin(distances, axis=0)
+		columns = np.arange(len(windows))
+		return songs_id[nearest, columns], offsets[nearest, columns], distances[nearest, columns]
+
+	def indexed(self):
+		"""
+		whether any shard holds signatures"""
+
+		return sum(self.sizes) > 0
+
+	def entries(self):
+		"""
+		the number of entries held by all shards"""
+
+		return sum(self.sizes)
+
+	def tune_probes(self, snippet_paths, target_recall = 0.9, max_probes = 4096, threads = 1):
+		"""
+		not supported, every shard has its own tables"""
+
+		raise ValueError("Probes can't be tuned for a sharded index.")
+
+	def save(self, path):
+		"""
+		not supported, the tables live in the worker processes"""
+
+		raise ValueError("A sharded index can't be saved.")
+
+	def close(self):
+		"""
+		stop every worker process"""
+
+		for connection in self.connections:
+			connection.send(('close', ()))
+			connection.close()
+		for process in self.processes:
+			process.join()
+
+
+def serve_shard(connection, options):
+	"""
+	the loop of a worker process, running the commands sent to its shard
+
+	params:
+		connection: the worker's end of the pipe
+		options: the parameters of the shard's Hashtable
+
+	"""
+
+	lsh = Hashtable(**options)
+	while True:
+		command, args = connection.recv()
+		if command == 'close':
+			connection.close()
+			return
+
+		try:
+			if command == 'add':
+				lsh.add(*args)
+				reply = len(lsh.song_ids)
+			elif command == 'merge':
+				reply = lsh.merge()
+			elif command == 'match':
+				reply = lsh.match_windows(*args)
+			else:
+				raise ValueError("Unknown command {}.".format(command))
+		except Exception as error:
+			reply = error
+		connection.send(reply)
+
+
+def receive_all(connections):
+	"""
+	receive the reply of every shard a command was sent to, errors included,
+	so that no reply is left in a pipe to be read by the next command
+
+	params:
+		connections: the pipes of the shards, in the order of the replies
+
+	returns:
+		the replies, with the error of a shard that failed or died in its place
+
+	"""
+
+	replies = []
+	for connection in connections:
+		try:
+			replies.append(connection.recv())
+		except (EOFError, OSError) as error:
+			replies.append(error)
+	return replies
+
+
+def raise_error(replies):
+	"""
+	raise the first error among the replies of the shards, if any"""
+
+	for reply in replies:
+		if isinstance(reply, Exception):
+			raise reply
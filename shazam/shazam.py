@@ -5,7 +5,10 @@
 
 from songClass import Song
 import database as db
-from hashing import Hashtable
+from hashing import Hashtable, FingerprintIndex
+from streaming import StreamIdentifier
+from store import SignatureStore
+from sharding import ShardedHashtable
 import os
 
 
@@ -13,7 +16,11 @@ class Shazam(object):
 	"""
 	a system that can identify the song given a snippet"""
 
-	def __init__(self, width = 10, shift = 1, window_type = 'hann', verbose = True):
+	def __init__(self, width = 10, shift = 1, window_type = 'hann', verbose = True,
+				 min_connections = 1, max_connections = 8, snapshot = None,
+				 projection = None, dimension = 256,
+				 lsh_family = None, num_tables = None, num_probes = None, store = None,
+				 shards = None):
 		"""
 		initiate a shazam object with user-defined window functions and parameters
 
@@ -21,6 +28,21 @@ class Shazam(object):
 			width: integer, the width of windows for signals
 			shift: integer, the distance between two windows
 			window_type: string, the type of window will be used for spectral analysis
+			min_connections: integer, the database connections kept open in the pool
+			max_connections: integer, the most database connections open at once
+			snapshot: string, a directory written by save; if given, the existing
+					  database is kept and the index is loaded instead of rebuilt
+			projection: string, None, 'random' or 'pca', reduces signatures to
+						dimension before LSH indexing
+			dimension: integer, the dimension of the projected signatures
+			lsh_family: string, 'CrossPolytope' or 'Hyperplane', falconn's default if None
+			num_tables: integer, the number of LSH tables, falconn's default if None
+			num_probes: integer, the buckets probed per query, one per table if None
+			store: string, a directory of a SignatureStore; if given, signatures are
+				   also kept in memory-mapped files there, and the index is built
+				   from them, for libraries larger than memory
+			shards: integer, if given, the index is partitioned by song across this
+					many worker processes, and every query is sent to all of them
 
 		"""
 
@@ -29,19 +51,55 @@ class Shazam(object):
 		self.window_type = window_type
 		self.verbose = verbose
 
-		# create a database for songs, and an empty hashing table for matching
-		self.database = db.Database().create_table()
-		self.lsh = Hashtable()
+		# a shared pool of database connections, used by every query of this object
+		self.pool = db.ConnectionPool(min_connections, max_connections)
 
+		if shards is not None and (snapshot is not None or store is not None):
+			raise ValueError("A sharded index is built in memory, without a snapshot or a store.")
 
-	def insert_songs(self, directory):
+		# warm start from a saved index over the existing database
+		if snapshot is not None:
+			self.database = None
+			self.lsh = Hashtable.load(snapshot, self.pool)
+			self.lsh.store = SignatureStore(store) if store is not None else None
+			self.width = self.lsh.analysis['width']
+			self.shift = self.lsh.analysis['shift']
+			self.window_type = self.lsh.analysis['window_type']
+			self.fingerprint_index = FingerprintIndex(self.pool)
+			self.fingerprint_index.add(*db.get_fingerprints(self.pool))
+			return
+
+		# create a database for songs, an empty hashing table for matching,
+		# and an empty inverted index of fingerprints
+		with db.connection(self.pool) as conn:
+			self.database = db.Database(conn).create_table()
+		options = dict(projection = projection, dimension = dimension,
+					   width = width, shift = shift, window_type = window_type,
+					   lsh_family = lsh_family, num_tables = num_tables, num_probes = num_probes)
+		if shards is not None:
+			self.lsh = ShardedHashtable(shards, self.pool, **options)
+		else:
+			store = SignatureStore(store, reset = True) if store is not None else None
+			self.lsh = Hashtable(self.pool, store = store, **options)
+		self.fingerprint_index = FingerprintIndex(self.pool)
+
+
+	def insert_songs(self, directory, workers = 1, batch_size = 1000,
+					 signatures = True, fingerprints = False):
 		"""
-		analyze a new song and add it to the database
+		analyze new songs and add them to the database and the index
+
+		songs already in the library are skipped, and the new signatures are
+		added to the index incrementally, without rebuilding it; if an insert
+		fails midway, the songs it committed are still indexed
 
 		params:
-			title: string, the title of the song
-			artist: string, the artist of the song
-			song_path: string, the path of the song ending with '.wav'
+			directory: string, a directory of songs in '.wav' format
+			workers: integer, the number of processes analyzing songs in parallel
+			batch_size: integer, the number of signatures written per transaction
+			signatures: boolean, index the windowed signatures for identify
+			fingerprints: boolean, index the peak-pair hashes for identify_fingerprints;
+						  both must be the same for every insert into a library
 
 		returns:
 			True if successful
@@ -51,17 +109,52 @@ class Shazam(object):
 		if len(directory) == 0:
 			raise ValueError("The directory path must not be empty.")
 
-		db.build_library(directory)
-		all_signatures = db.get_all_signatures()
-
-		self.lsh.build_lsh(all_signatures)
+		store = self.lsh.store if signatures else None
+		try:
+			db.build_library(directory, workers, batch_size, self.pool, signatures, fingerprints,
+							 self.width, self.shift, self.window_type, store)
+		finally:
+			# songs committed before a failure are indexed all the same
+			self.index_songs(signatures, fingerprints)
 
-		if not self.lsh.table or not self.lsh.query_object:
-			return False
+		if signatures:
+			if not self.lsh.indexed():
+				return False
 
 		return True
 
 
+	def index_songs(self, signatures = True, fingerprints = False):
+		"""
+		add the songs of the database that the index doesn't hold yet
+
+		the index resumes after the entries and songs it already holds, rather
+		than from where the database stood before an insert, so songs committed
+		by an insert that failed midway are never left out
+
+		params:
+			signatures: boolean, index the new windowed signatures
+			fingerprints: boolean, index the new peak-pair hashes
+
+		"""
+		if fingerprints:
+			self.fingerprint_index.add(*db.get_fingerprints(self.pool, self.fingerprint_index.next_song()))
+
+		if not signatures:
+			return
+
+		# with a store, the new rows are read from its memory maps, not the database
+		start = self.lsh.entries()
+		store = self.lsh.store
+		if store is not None:
+			self.lsh.add(store.signatures()[start:], store.song_ids()[start:],
+						 store.offsets()[start:])
+		else:
+			new_signatures = db.get_all_signatures(self.pool, start)
+			self.lsh.add(new_signatures, db.get_entry_song_ids(self.pool, start),
+						 db.get_entry_offsets(self.pool, start))
+
+
 	def identify(self, snippet_path, K, threshold):
 		"""
 		identify the K nearest song(s) that match(es) the snippet
@@ -83,9 +176,146 @@ class Shazam(object):
 		return self.lsh.search_nearest(snippet_path, int(K), threshold)
 
 
+	def identify_aligned(self, snippet_path, K, threshold, min_votes = 2):
+		"""
+		identify the K song(s) that the most windows of the snippet agree on,
+		at a consistent time offset
+
+		params:
+			snippet_path: string, the path of the snippet ending with '.wav'
+			K: the number of songs returned
+			threshold: the max distance of a snippet window that votes
+			min_votes: integer, the fewest agreeing windows of a song matched
+
+		returns:
+			a list of the id and title, the votes and the start offset (in
+			windows) of each song matched, with the most votes first;
+			None if not matched
+
+		"""
+		if len(snippet_path) == 0:
+			raise ValueError("The snippet_path must not be empty.")
+		elif K <= 0:
+			raise ValueError("K must be a positive integer.")
+
+		return self.lsh.search_aligned([snippet_path], int(K), threshold, min_votes)[0]
+
+
+	def identify_fingerprints(self, snippet_path, K, min_votes = 5):
+		"""
+		identify the K song(s) sharing the most peak-pair hashes with the snippet,
+		using the inverted index instead of the LSH table
+
+		params:
+			snippet_path: string, the path of the snippet ending with '.wav'
+			K: the number of songs returned
+			min_votes: integer, the fewest time-aligned hashes of a song matched
+
+		returns:
+			a list of the id and title, the votes and the start offset (in
+			spectrogram frames) of each song matched, with the most votes first;
+			None if not matched
+
+		"""
+		if len(snippet_path) == 0:
+			raise ValueError("The snippet_path must not be empty.")
+		elif K <= 0:
+			raise ValueError("K must be a positive integer.")
+
+		return self.fingerprint_index.search(snippet_path, int(K), min_votes)
+
+
+	def identify_many(self, snippet_paths, K, threshold, threads = None):
+		"""
+		identify the K nearest song(s) of many snippets concurrently
+
+		params:
+			snippet_paths: list, the paths of the snippets ending with '.wav'
+			K: the K nearest neighbors of every snippet
+			threshold: the min distance should be no larger than the threshold
+			threads: integer, the number of threads used, one per cpu by default
+
+		returns:
+			a list with the result of identify for every snippet, in order
+
+		"""
+		if any(len(path) == 0 for path in snippet_paths):
+			raise ValueError("The snippet_path must not be empty.")
+		elif K <= 0:
+			raise ValueError("K must be a positive integer.")
+
+		if len(snippet_paths) == 0:
+			return []
+
+		threads = threads or os.cpu_count() or 1
+		return self.lsh.search_many(snippet_paths, int(K), threshold, threads)
+
+
+	def identify_stream(self, stream, threshold, votes = 3, sampRate = 44100, nchannels = 2):
+		"""
+		identify the song playing in a live feed, as soon as enough windows agree
+
+		params:
+			stream: a binary file-like object of raw interleaved 16-bit PCM frames
+			threshold: the max distance of a window that votes for a song
+			votes: integer, the number of windows that must agree on a song
+			sampRate: integer, number of frames in each second of the feed
+			nchannels: integer, 1 = mono, 2 = stereo
+
+		returns:
+			the id and title of the song matched, and its min distance;
+			None if the stream ends before a match
+
+		"""
+		if not self.lsh.indexed():
+			raise ValueError("Songs must be inserted before identifying.")
+
+		identifier = StreamIdentifier(self.lsh, threshold, votes, sampRate, nchannels,
+									  self.width, self.shift, self.window_type)
+		return identifier.identify(stream)
+
+
+	def tune(self, snippet_paths, target_recall = 0.9, max_probes = 4096):
+		"""
+		pick the fewest LSH probes that reach a target recall on held-out snippets
+
+		params:
+			snippet_paths: list, the paths of held-out snippets ending with '.wav'
+			target_recall: float, the fraction of snippet windows whose LSH
+						   nearest neighbor must be the exact one
+			max_probes: integer, the most probes tried
+
+		returns:
+			the number of probes picked (now used by identify), and its recall
+
+		"""
+		if not self.lsh.indexed():
+			raise ValueError("Songs must be inserted before tuning.")
+		elif not 0 < target_recall <= 1:
+			raise ValueError("The target recall must be between 0 and 1.")
+
+		return self.lsh.tune_probes(snippet_paths, target_recall, max_probes)
+
+
 	def list(self):
 		"""
 		get a list of all songs in the database"""
 
-		return db.get_all_songs()
+		return db.get_all_songs(self.pool)
+
+
+	def save(self, path):
+		"""
+		save the index to a directory, to warm start with Shazam(snapshot = path)"""
+
+		self.lsh.save(path)
+
+
+	def close(self):
+		"""
+		close every database connection in the pool, and the shards if any"""
+
+		if isinstance(self.lsh, ShardedHashtable):
+			self.lsh.close()
+		self.pool.closeall()
 
@@ -8,12 +8,29 @@ import wave as wv
 import numpy as np
 import pylab as pl
 import scipy.signal as signal
+import scipy.ndimage as ndimage
+from numpy.lib.stride_tricks import sliding_window_view
+
+# number of peaks kept per window, and windows analyzed per batch
+N_PEAKS = 5000
+BATCH_WINDOWS = 8
+
+# spectrogram and constellation parameters of the peak-pair fingerprints:
+# frames of FP_NPERSEG samples every FP_HOP samples, the lowest FP_BINS
+# frequency bins, one peak per FP_NEIGHBORHOOD (bins, frames), and each peak
+# paired with the next FP_FAN_OUT peaks at most FP_MAX_DT frames later
+FP_NPERSEG = 2048
+FP_HOP = 1024
+FP_BINS = 1024
+FP_NEIGHBORHOOD = (31, 31)
+FP_FAN_OUT = 5
+FP_MAX_DT = 127
 
 class Song(object):
 	"""
 	a class that can efficient analyze a '.wav' file, for building a music database"""
 
-	def __init__(self, title = None, path = None, verbose = False):
+	def __init__(self, title = None, path = None, verbose = False, stream = False):
 		"""
 		initiate the attributes of a song object
 
@@ -21,6 +38,8 @@ class Song(object):
 			title: the song's name ending with '.wav'
 			path: the song's path(name) ending with '.wav'
 			verbose: False by default
+			stream: if True, frames are read window by window while analyzing,
+					instead of all at once here (rawWave is then None)
 			
 			nchannels: 1 = mono, 2 = stereo
 			sampWidth: number of frames in each sample
@@ -39,7 +58,7 @@ class Song(object):
 		self.sampWidth = self.wavData.getsampwidth()
 		self.sampRate = self.wavData.getframerate()
 		self.totalFrames = self.wavData.getnframes()
-		self.rawWave = self.wavData.readframes(self.totalFrames)
+		self.rawWave = None if stream else self.wavData.readframes(self.totalFrames)
 		self.length = int(self.totalFrames // self.sampRate 
 			+ (self.totalFrames % self.sampRate) / self.sampRate)
 
@@ -47,47 +66,101 @@ class Song(object):
 		"""
 		analyze the signature of a song with windowing and spectral analysis
 
+		all windows are strided views over the samples (no per-window copies),
+		and are analyzed BATCH_WINDOWS at a time to bound the working memory;
+		a streamed song is analyzed one window at a time with iter_signatures
+
 		params:
 			width: the width of windows
 			shift: the shift between two windows
 			window_type: the function type for windowing
 
 		returns:
-			signature: a numpy array of 5000 peaks per window, 
-					   serving as the signature of one song
+			signature: a contiguous float32 matrix with one row of N_PEAKS
+					   peaks per window, serving as the signature of one song
+
+		"""
+
+		if self.rawWave is None:
+			signature = list(self.iter_signatures(width, shift, window_type))
+			if len(signature) == 0:
+				return np.empty((0, N_PEAKS), dtype = np.float32)
+			return np.vstack(signature)
+
+		return window_signatures(self.samples(), self.sampRate, width, shift, window_type)
+
+
+	def iter_signatures(self, width = 10, shift = 1, window_type = 'hann'):
+		"""
+		analyze the song window by window, reading its frames as they are needed
+
+		only the frames of the current window are held in memory, so the peak
+		memory doesn't grow with the length of the song
+
+		params:
+			width: the width of windows
+			shift: the shift between two windows
+			window_type: the function type for windowing
+
+		yields:
+			signature: a float32 array of N_PEAKS peaks for each window, the
+					   same rows as analyzer returns
 
 		"""
 
-		totalFrames = self.totalFrames
-		channels = self.nchannels
-		sampRate = self.sampRate
-		rawWave = self.rawWave
-		songLength = self.length
+		window = signal.get_window(window_type, self.sampRate * width)
+		size = len(window)
+		step = self.sampRate * shift
 
-		song = np.fromstring(rawWave, dtype = np.short)
-		song.shape = -1, 2
-		if channels == 2:
-			song = np.mean(song.T, axis = 0)
+		self.wavData.rewind()
+		song = self.decode(self.wavData.readframes(size))
 
-		window = signal.get_window(window_type, sampRate * width)
-		window_num = int((totalFrames - sampRate * width) / sampRate)
-		window_list = []
-		for i in range(0, window_num + 1):
-			window_list.append(window * song[i*sampRate: (i+width)*sampRate])
+		while len(song) == size:
+			yield peak_signature((song * window)[np.newaxis])[0]
 
-		N = 5000
-		signature = []
+			if step < size:
+				song = np.concatenate([song[step:], self.decode(self.wavData.readframes(step))])
+			else:
+				# skip the gap between two windows that don't overlap
+				self.wavData.readframes(step - size)
+				song = self.decode(self.wavData.readframes(size))
 
-		for i, window in enumerate(window_list):
-			freq_index = signal.argrelextrema(window, np.greater)
-			freq_index = freq_index[0].argsort()[-N:][::-1]
-			freq_raw = window[freq_index]
-			mins = np.min(freq_raw, axis = 0)
-			maxs = np.max(freq_raw, axis = 0)
-			freq_norm = (freq_raw - mins) / (maxs - mins)
-			signature.append(freq_norm)
 
-		return signature
+	def fingerprints(self):
+		"""
+		fingerprint the song with hashes of pairs of spectrogram peaks
+
+		the peaks are picked over the spectrogram of the whole song (against its
+		mean magnitude), so even a streamed song is decoded in whole here, and
+		the memory used grows with the length of the song
+
+		returns:
+			hashes: a uint32 array, one hash per pair of peaks
+			times: an int32 array, the spectrogram frame of each pair's first peak
+
+		"""
+
+		if self.rawWave is None:
+			self.wavData.rewind()
+			song = self.decode(self.wavData.readframes(self.totalFrames))
+		else:
+			song = self.samples()
+
+		return constellation_hashes(song)
+
+
+	def samples(self):
+		"""
+		decode the raw frames into a mono array of samples, averaging the channels"""
+
+		return self.decode(self.rawWave)
+
+
+	def decode(self, rawWave):
+		"""
+		decode raw frames into a mono array of samples, averaging the channels"""
+
+		return decode_frames(rawWave, self.nchannels)
 
 
 	def metaData(self):
@@ -108,4 +181,126 @@ class Song(object):
 					self.totalFrames)
 
 		return _metaData
-    	
\ No newline at end of file
+
+
+def decode_frames(rawWave, nchannels):
+	"""
+	decode raw 16-bit PCM frames into a mono array of samples, averaging the channels
+
+	params:
+		rawWave: bytes of whole interleaved frames
+		nchannels: 1 = mono, 2 = stereo
+
+	returns:
+		song: a float array with one sample per frame
+
+	"""
+
+	song = np.frombuffer(rawWave, dtype = np.short)
+	song = song.reshape(-1, nchannels)
+	return np.mean(song, axis = 1)
+
+
+def window_signatures(song, sampRate, width = 10, shift = 1, window_type = 'hann'):
+	"""
+	analyze decoded samples window by window, as Song.analyzer
+
+	params:
+		song: a mono array of samples
+		sampRate: the sample rate of the song
+		width, shift, window_type: the parameters of Song.analyzer
+
+	returns:
+		signature: a contiguous float32 matrix with one row of N_PEAKS peaks per window
+
+	"""
+
+	window = signal.get_window(window_type, sampRate * width)
+	if len(song) < len(window):
+		return np.empty((0, N_PEAKS), dtype = np.float32)
+
+	frames = sliding_window_view(song, len(window))[::sampRate * shift]
+	signature = np.empty((len(frames), N_PEAKS), dtype = np.float32)
+
+	for i in range(0, len(frames), BATCH_WINDOWS):
+		block = frames[i: i + BATCH_WINDOWS] * window
+		signature[i: i + len(block)] = peak_signature(block)
+
+	return signature
+
+
+def peak_signature(frames, N = N_PEAKS):
+	"""
+	select the N highest local maxima of every windowed frame, normalized to [0, 1]
+
+	params:
+		frames: a 2-d array with one windowed frame per row
+		N: the number of peaks kept per frame
+
+	returns:
+		freq_norm: a float32 matrix of shape (len(frames), N), peaks in descending
+				   order; frames with fewer than N peaks are padded with zeros
+
+	"""
+
+	inner = frames[:, 1:-1]
+	peaks = (inner > frames[:, :-2]) & (inner > frames[:, 2:])
+	amplitude = np.where(peaks, inner, -np.inf)
+
+	if amplitude.shape[1] < N:
+		padding = np.full((len(amplitude), N - amplitude.shape[1]), -np.inf)
+		amplitude = np.hstack([amplitude, padding])
+
+	# partial selection of the top N peaks, then only those N are sorted
+	top = np.argpartition(amplitude, -N, axis = 1)[:, -N:]
+	freq_raw = np.take_along_axis(amplitude, top, axis = 1)
+	freq_raw = -np.sort(-freq_raw, axis = 1)
+
+	found = np.isfinite(freq_raw)
+	maxs = freq_raw[:, :1]
+	mins = np.min(np.where(found, freq_raw, np.inf), axis = 1, keepdims = True)
+	span = np.where(maxs > mins, maxs - mins, 1)
+
+	with np.errstate(invalid = 'ignore'):
+		freq_norm = np.where(found, (freq_raw - mins) / span, 0)
+
+	return freq_norm.astype(np.float32)
+
+
+def constellation_hashes(song, fan_out = FP_FAN_OUT):
+	"""
+	hash pairs of peaks of the spectrogram (the constellation) into 32-bit integers
+
+	each hash packs the frequency bins of both peaks (10 bits each) and the
+	frames between them (12 bits), so it doesn't depend on where the pair is
+
+	params:
+		song: a mono array of samples
+		fan_out: the number of later peaks each peak is paired with
+
+	returns:
+		hashes: a uint32 array, one hash per pair of peaks
+		times: an int32 array, the spectrogram frame of each pair's first peak
+
+	"""
+
+	if len(song) < FP_NPERSEG:
+		return np.empty(0, dtype = np.uint32), np.empty(0, dtype = np.int32)
+
+	_, _, spec = signal.spectrogram(song.astype(np.float32), nperseg = FP_NPERSEG,
+									noverlap = FP_NPERSEG - FP_HOP, mode = 'magnitude')
+	spec = spec[:FP_BINS]
+
+	peaks = (spec == ndimage.maximum_filter(spec, size = FP_NEIGHBORHOOD)) & (spec > np.mean(spec))
+	freq, time = np.nonzero(peaks)
+	order = np.lexsort((freq, time))
+	freq, time = freq[order].astype(np.uint32), time[order].astype(np.uint32)
+
+	hashes, times = [], []
+	for j in range(1, fan_out + 1):
+		dt = time[j:] - time[:-j]
+		keep = dt <= FP_MAX_DT
+		hashes.append((freq[:-j][keep] << 22) | (freq[j:][keep] << 12) | dt[keep])
+		times.append(time[:-j][keep])
+
+	return np.concatenate(hashes).astype(np.uint32), np.concatenate(times).astype(np.int32)
@@ -0,0 +1,110 @@
+# Title: Signature Store
+# Project: Shazam
+# Author: Sijia Liu
+# Date: Dec. 2017
+
+import os
+import shutil
+import numpy as np
+from songClass import N_PEAKS
+
+
+class SignatureStore(object):
+	"""
+	a file-backed, append-only store of float32 signatures with the song_id and
+	window offset of every row, read through memory maps so that libraries
+	larger than memory can be indexed"""
+
+	def __init__(self, path, width = N_PEAKS, reset = False):
+		"""
+		open (or create) a store in a directory
+
+		params:
+			path: the directory of the store, created if it doesn't exist
+			width: the number of floats in every signature
+			reset: if True, remove every signature already in the store
+
+		"""
+
+		if reset and os.path.exists(path):
+			shutil.rmtree(path)
+		os.makedirs(path, exist_ok=True)
+
+		self.path = path
+		self.width = width
+		self.signatures_path = os.path.join(path, 'signatures.f32')
+		self.song_ids_path = os.path.join(path, 'song_ids.i64')
+		self.offsets_path = os.path.join(path, 'offsets.i64')
+
+		for path in (self.signatures_path, self.song_ids_path, self.offsets_path):
+			open(path, 'ab').close()
+
+	def __len__(self):
+		"""
+		the number of complete rows, ignoring a partially written append"""
+
+		return min(os.path.getsize(self.signatures_path) // (4 * self.width),
+				   os.path.getsize(self.song_ids_path) // 8,
+				   os.path.getsize(self.offsets_path) // 8)
+
+	def append(self, signatures, song_ids, offsets):
+		"""
+		append rows to the end of the store
+
+		params:
+			signatures: a matrix of signatures, one per row
+			song_ids: the song_id of every signature
+			offsets: the window offset of every signature in its song
+
+		"""
+
+		signatures = np.ascontiguousarray(signatures, dtype=np.float32)
+		if signatures.ndim != 2 or signatures.shape[1] != self.width:
+			raise ValueError("Signatures must be rows of {} floats.".format(self.width))
+		if not len(signatures) == len(song_ids) == len(offsets):
+			raise ValueError("Every signature must have a song_id and an offset.")
+
+		with open(self.signatures_path, 'ab') as f:
+			f.write(signatures.tobytes())
+		with open(self.song_ids_path, 'ab') as f:
+			f.write(np.asarray(song_ids, dtype=np.int64).tobytes())
+		with open(self.offsets_path, 'ab') as f:
+			f.write(np.asarray(offsets, dtype=np.int64).tobytes())
+
+	def truncate(self, n):
+		"""
+		drop every row after the first n, e.g. of an append whose songs weren't committed"""
+
+		if n < 0:
+			raise ValueError("The number of rows must not be negative.")
+		n = min(n, len(self))
+		for path, size in ((self.signatures_path, 4 * self.width),
+						   (self.song_ids_path, 8), (self.offsets_path, 8)):
+			with open(path, 'r+b') as f:
+				f.truncate(n * size)
+
+	def signatures(self):
+		"""
+		map the signatures into memory, read-only; pages are only read when used
+
+		returns:
+			a float32 matrix (a numpy.memmap) of shape (len(self), width)
+
+		"""
+
+		n = len(self)
+		if n == 0:
+			return np.empty((0, self.width), dtype=np.float32)
+		return np.memmap(self.signatures_path, dtype=np.float32, mode='r', shape=(n, self.width))
+
+	def song_ids(self):
+		"""
+		read the song_id of every row"""
+
+		return np.fromfile(self.song_ids_path, dtype=np.int64, count=len(self))
+
+	def offsets(self):
+		"""
+		read the window offset of every row"""
+
+		return np.fromfile(self.offsets_path, dtype=np.int64, count=len(self))
@@ -0,0 +1,162 @@
+# Title: Streaming
+# Project: Shazam
+# Author: Sijia Liu
+# Date: Dec. 2017
+
+import asyncio
+import numpy as np
+import scipy.signal as signal
+from songClass import decode_frames, peak_signature
+import database as db
+
+
+class StreamIdentifier(object):
+	"""
+	a class that identifies a song from a live feed of PCM audio, as soon as
+	enough of its windows agree on the same song"""
+
+	def __init__(self, lsh, threshold, votes = 3, sampRate = 44100, nchannels = 2,
+				 width = 10, shift = 1, window_type = 'hann'):
+		"""
+		initiate a stream identifier over a built hash table
+
+		params:
+			lsh: a Hashtable with the LSH table built
+			threshold: the max distance of a window that votes for a song
+			votes: the number of windows that must agree on a song to match it
+			sampRate: number of frames in each second of the feed
+			nchannels: 1 = mono, 2 = stereo
+			width: the width of windows, the same as the library's
+			shift: the shift between two windows, the same as the library's
+			window_type: the function type for windowing, the same as the library's
+
+		"""
+
+		if votes < 1:
+			raise ValueError("The number of votes must be a positive integer.")
+
+		self.lsh = lsh
+		self.threshold = threshold
+		self.votes = votes
+		self.sampRate = sampRate
+		self.nchannels = nchannels
+		self.window = signal.get_window(window_type, sampRate * width)
+		self.step = sampRate * shift
+
+		self.reset()
+
+	def reset(self):
+		"""
+		forget the buffered audio and the votes, to identify a new song"""
+
+		self.pending = b''
+		self.samples = np.empty(0)
+		self.skip = 0
+		self.counts = {}
+		self.distances = {}
+		self.windows = 0
+		self.match = None
+
+	def feed(self, chunk):
+		"""
+		add PCM audio to the rolling window, and analyze every window completed
+
+		params:
+			chunk: bytes of interleaved 16-bit PCM frames, of any length
+
+		returns:
+			match: the (song_id, title) and distance of the song matched,
+				   None while not enough windows agree
+
+		"""
+
+		if self.match is not None:
+			return self.match
+
+		# keep a partial frame until the rest of it arrives
+		frame_size = 2 * self.nchannels
+		data = self.pending + bytes(chunk)
+		usable = len(data) - len(data) % frame_size
+		self.pending = data[usable:]
+		samples = decode_frames(data[:usable], self.nchannels)
+
+		# drop the gap between two windows that don't overlap
+		if self.skip:
+			dropped = min(self.skip, len(samples))
+			samples = samples[dropped:]
+			self.skip -= dropped
+
+		self.samples = np.concatenate([self.samples, samples])
+
+		size = len(self.window)
+		while len(self.samples) >= size and self.match is None:
+			self.analyze(self.samples[:size])
+
+			dropped = min(self.step, len(self.samples))
+			self.skip = self.step - dropped
+			self.samples = self.samples[dropped:]
+
+		return self.match
+
+	def analyze(self, frame):
+		"""
+		analyze one full window, and let it vote for its nearest song"""
+
+		signature = peak_signature((frame * self.window)[np.newaxis])
+		songs_id, _, distances = self.lsh.match_windows(signature, 1)
+		self.windows += 1
+
+		if distances[0] > self.threshold:
+			return
+
+		song_id = int(songs_id[0])
+		self.counts[song_id] = self.counts.get(song_id, 0) + 1
+		self.distances[song_id] = min(self.distances.get(song_id, np.inf), distances[0])
+
+		if self.counts[song_id] >= self.votes:
+			song_info = db.get_songs_info([song_id], self.lsh.pool)[song_id]
+			self.match = (song_info, self.distances[song_id])
+
+	def identify(self, stream, chunk_size = 4096):
+		"""
+		read PCM audio from a file-like object (e.g. a pipe) until a song matches
+
+		params:
+			stream: a binary file-like object of raw interleaved 16-bit PCM frames
+			chunk_size: the number of frames read at a time
+
+		returns:
+			the match as returned by feed, None if the stream ends before a match
+
+		"""
+
+		while self.match is None:
+			chunk = stream.read(chunk_size * 2 * self.nchannels)
+			if not chunk:
+				break
+			self.feed(chunk)
+
+		return self.match
+
+	async def identify_async(self, reader, chunk_size = 4096):
+		"""
+		read PCM audio from an asyncio stream until a song matches; windows are
+		analyzed in the default executor so the event loop is not blocked
+
+		params:
+			reader: an asyncio.StreamReader of raw interleaved 16-bit PCM frames
+			chunk_size: the most frames read at a time
+
+		returns:
+			the match as returned by feed, None if the stream ends before a match
+
+		"""
+
+		loop = asyncio.get_running_loop()
+		while self.match is None:
+			chunk = await reader.read(chunk_size * 2 * self.nchannels)
+			if not chunk:
+				break
+			await loop.run_in_executor(None, self.feed, chunk)
+
+		return self.match
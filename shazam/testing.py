@@ -4,7 +4,13 @@
 # Date: Dec. 2017
 
 import unittest
+import io
+import json
+import asyncio
 import os
+import shutil
+import tempfile
+import threading
 import re
 import random
 import struct
@@ -16,13 +22,40 @@ import falconn
 from pydub import AudioSegment
 from songClass import Song
 import database as db
-from hashing import Hashtable
+from hashing import Hashtable, FingerprintIndex
 from shazam import Shazam
+from streaming import StreamIdentifier
+from store import SignatureStore
+from sharding import ShardedHashtable
+from server import IdentificationServer
+import benchmark
 
 
 class test_shazam(unittest.TestCase):
 	"""Unittest cases and randomized tests for shazam"""
 
+	def make_shazam(self, signatures = True, fingerprints = False, **options):
+		"""
+		create a Shazam object, and insert the songs of './' without the snippets
+		left by other tests
+
+		params:
+			signatures, fingerprints: the analyses inserted, as for Shazam.insert_songs
+			options: the parameters of Shazam
+
+		returns:
+			the Shazam object
+
+		"""
+
+		Shz = Shazam(**options)
+		for f in os.listdir('./'):
+			if re.search('snippet.wav', f):
+				os.remove(f)
+		self.assertTrue(Shz.insert_songs('./', signatures = signatures, fingerprints = fingerprints))
+		return Shz
+
+
 	def test_song(self):
 		"""test the song class with two random noise waves"""
 
@@ -50,6 +83,16 @@ class test_shazam(unittest.TestCase):
 		self.assertEqual(len(song2.analyzer()), song2.length-width+1)
 		self.assertEqual(len(song1.analyzer()[0]), 5000)  # number of peaks in each window
 		self.assertEqual(len(song2.analyzer()[1]), 5000)
+		self.assertEqual(song1.analyzer().shape, (song1.length-width+1, 5000))  # one contiguous matrix
+		self.assertEqual(song1.analyzer().dtype, np.float32)
+		self.assertTrue(song1.analyzer().flags['C_CONTIGUOUS'])
+
+		# a streamed song yields the same windows without loading all frames
+		stream1 = Song('noise1.wav', 'noise1.wav', stream = True)
+		self.assertIsNone(stream1.rawWave)
+		self.assertEqual(stream1.length, 60)
+		self.assertTrue(np.array_equal(np.vstack(list(stream1.iter_signatures())), song1.analyzer()))
+		self.assertTrue(np.array_equal(stream1.analyzer(shift = 3), song1.analyzer(shift = 3)))
 
 
 	def test_database(self):
@@ -72,8 +115,8 @@ class test_shazam(unittest.TestCase):
 		i = cur.fetchone()
 		self.assertIsNone(i)
 
-		# test build_library
-		self.assertTrue(db.build_library("./"))
+		# test build_library, with small batches to exercise several COPY transactions
+		self.assertTrue(db.build_library("./", batch_size = 7))
 		cur.execute("SELECT id, title from songs")
 		i = cur.fetchone()
 		self.assertEqual(i[0], 0)	# first song_id
@@ -83,7 +126,18 @@ class test_shazam(unittest.TestCase):
 		i = cur.fetchone()
 		self.assertEqual(i[0], 0)	# first entry_id
 		self.assertEqual(i[1], 0)	# first song_id
-		self.assertTrue(len(i[2]) > 0)	# length of first song's all signatures
+		self.assertEqual(i[2], 0)	# window offset of the first signature in its song
+		self.assertEqual(len(i[3]), 5000 * 4)	# packed float32 bytes of the first signature window
+
+		cur.execute("SELECT COUNT(*) from signatures")
+		windows = sum(Song(f, f).length-10+1 for f in os.listdir("./") if f.endswith(".wav"))
+		self.assertEqual(cur.fetchone()[0], windows)	# every window of every song
+
+		# test analyze_song, the unit of work of the parallel ingest
+		song_id, title, signatures, fingerprints = db.analyze_song((0, 'noise1.wav', './noise1.wav', True, False, {}))
+		self.assertEqual((song_id, title), (0, 'noise1.wav'))
+		self.assertTrue(np.array_equal(signatures, Song('noise1.wav', 'noise1.wav').analyzer()))
+		self.assertIsNone(fingerprints)
 
 		# test get_song_info
 		rst = db.get_song_info(0)
@@ -94,15 +148,95 @@ class test_shazam(unittest.TestCase):
 		rst = db.get_song_signature(0)
 		self.assertEqual(rst[0], 0)	# first song_id
 
-		cur.execute("SELECT * from signatures")
-		i = cur.fetchone()
-		self.assertEqual(len(rst[1]), len(i[2])) # length of first song's all signatures
+		self.assertEqual(rst[1].dtype, np.float32)
+		self.assertEqual(len(rst[1]), 5000) # length of first signature window
+		self.assertTrue(np.array_equal(rst[1], Song('noise1.wav', 'noise1.wav').analyzer()[0]))
+
+		# test the batched lookups
+		rst = db.get_songs_info([0, 1, 0])
+		self.assertEqual(rst[0], db.get_song_info(0))
+		self.assertEqual(rst[1], db.get_song_info(1))
+		self.assertEqual(len(rst), 2)
+
+		rst = db.get_signatures([0, 1])
+		self.assertEqual(rst[0][0], db.get_song_signature(0)[0])
+		self.assertTrue(np.array_equal(rst[1][1], db.get_song_signature(1)[1]))
+		self.assertEqual(db.get_signatures([-1]), {})
+
+		# test get_entry_offsets, counting the windows of each song from 0
+		offsets = db.get_entry_offsets()
+		song_ids = db.get_entry_song_ids()
+		self.assertEqual(offsets[0], 0)
+		self.assertEqual(list(offsets[song_ids == 1]), list(range(np.sum(song_ids == 1))))
 
 		# test get_all_signatures
 		all_signatures = db.get_all_signatures()
 		self.assertEqual(len(all_signatures[0]), 5000) # length of first signature window
 
 
+	def test_ingest_failure(self):
+		"""test a song failing midway through ingest leaves no song without its signatures"""
+
+		with db.connection() as conn:
+			db.Database(conn).create_table()
+		directory = tempfile.mkdtemp()
+		for i in range(3):
+			writeWav(os.path.join(directory, 'noise{}.wav'.format(i)), 12 + i)
+		with open(os.path.join(directory, 'broken.wav'), 'wb') as f:
+			f.write(b'RIFF, but not a wave')
+		store = SignatureStore(os.path.join(directory, 'store'))
+
+		def check():
+			song_ids = db.get_entry_song_ids()
+			for song_id, title in db.get_all_songs():
+				self.assertEqual(np.sum(song_ids == song_id), 12 + int(title[5]) - 10 + 1)
+			self.assertEqual(len(store), len(song_ids))
+			self.assertTrue(np.array_equal(store.song_ids(), song_ids))
+
+		# one row per batch, so songs ingested before the failure are committed
+		self.assertRaises(wv.Error, db.build_library, directory, workers = 2, batch_size = 1, store = store)
+		check()
+
+		# the songs that failed are not skipped the next time
+		os.remove(os.path.join(directory, 'broken.wav'))
+		self.assertTrue(db.build_library(directory, workers = 2, batch_size = 1, store = store))
+		self.assertEqual(len(db.get_all_songs()), 3)
+		check()
+		shutil.rmtree(directory)
+
+
+	def test_insert_failure(self):
+		"""test the songs committed before an insert fails are indexed, and only once"""
+
+		Shz = Shazam()
+		directory = tempfile.mkdtemp()
+		for i in range(3):
+			writeWav(os.path.join(directory, 'noise{}.wav'.format(i)), 12 + i)
+		with open(os.path.join(directory, 'broken.wav'), 'wb') as f:
+			f.write(b'RIFF, but not a wave')
+
+		def check():
+			song_ids = set(song_id for song_id, _ in Shz.list())
+			self.assertEqual(Shz.lsh.entries(), len(db.get_entry_song_ids(Shz.pool)))
+			self.assertEqual(set(Shz.lsh.song_ids if Shz.lsh.entries() else []), song_ids)
+			self.assertEqual(set(Shz.fingerprint_index.song_ids), song_ids)
+
+		# one row per batch, so songs analyzed before the failure are committed
+		self.assertRaises(wv.Error, Shz.insert_songs, directory, batch_size = 1, fingerprints = True)
+		check()
+
+		os.remove(os.path.join(directory, 'broken.wav'))
+		self.assertTrue(Shz.insert_songs(directory, batch_size = 1, fingerprints = True))
+		self.assertEqual(len(Shz.list()), 3)
+		check()
+
+		getSnippet(os.path.join(directory, 'noise2.wav'), 'noise2_snippet.wav', 11)
+		self.assertEqual(Shz.identify('noise2_snippet.wav', 1, 0.0001)[0][0][1], 'noise2.wav')
+		os.remove('noise2_snippet.wav')
+		shutil.rmtree(directory)
+		Shz.close()
+
+
 	def test_hashing(self):
 		"""test the LSH class with random snippets"""
 
@@ -113,13 +247,19 @@ class test_shazam(unittest.TestCase):
 		# test build_lsh
 		database = db.Database()
 		database.create_table()
-		db.build_library("./")
+		db.build_library("./", workers = 2)
 
 		all_signatures = db.get_all_signatures()
 		Hst.build_lsh(all_signatures)
 		self.assertIsNotNone(Hst.table)
 		self.assertIsNotNone(Hst.query_object)
 
+		# the centered matrix and the song_id of each entry stay in memory
+		self.assertEqual(Hst.signatures.shape, all_signatures.shape)
+		self.assertEqual(len(Hst.song_ids), len(all_signatures))
+		self.assertTrue(np.allclose(Hst.signatures.mean(axis = 0), 0, atol = 1e-4))
+		self.assertEqual(Hst.song_ids[0], db.get_song_signature(0)[0])
+
 		getSnippet('noise1.wav', 'noise1_snippet.wav', 15)
 		getSnippet('noise2.wav', 'noise2_snippet.wav', 12)
 
@@ -129,6 +269,27 @@ class test_shazam(unittest.TestCase):
 		self.assertEqual(Hst.search_nearest('noise2_snippet.wav', 1, 0.0001)[0][0], (1, 'noise2.wav'))	# id of noise2.wav
 		self.assertEqual(Hst.search_nearest('noise2_snippet.wav', 1, 0.0001)[1], [0.])	# distances between noise2.wav and the snippet < 0.0001
 
+		# test the projections before LSH indexing, re-ranked in the full dimension
+		for projection in ('random', 'pca'):
+			Prj = Hashtable(projection = projection, dimension = 64)
+			Prj.build_lsh(db.get_all_signatures())
+			self.assertEqual(Prj.points.shape, (len(Prj.signatures), 64))
+			self.assertEqual(Prj.params.dimension, 64)
+			self.assertEqual(Prj.search_nearest('noise1_snippet.wav', 1, 0.0001)[0][0], (0, 'noise1.wav'))
+			self.assertEqual(Prj.search_nearest('noise2_snippet.wav', 1, 0.0001)[1], [0.])
+		self.assertRaises(ValueError, Hashtable, projection = 'svd')
+
+		# test save and load, a warm start over the same database
+		path = tempfile.mkdtemp()
+		Hst.save(path)
+		loaded = Hashtable.load(path)
+		self.assertTrue(np.array_equal(loaded.signatures, Hst.signatures))
+		self.assertTrue(np.array_equal(loaded.song_ids, Hst.song_ids))
+		self.assertEqual(loaded.params.seed, Hst.params.seed)
+		self.assertEqual(loaded.search_nearest('noise1_snippet.wav', 1, 0.0001)[0][0], (0, 'noise1.wav'))
+		self.assertEqual(loaded.search_nearest('noise2_snippet.wav', 1, 0.0001)[0][0], (1, 'noise2.wav'))
+		shutil.rmtree(path)
+
 
 	def test_shazam(self):
 		"""test the shazam with 10 random signatures and one snippet"""
@@ -163,11 +324,370 @@ class test_shazam(unittest.TestCase):
 		getSnippet('noise3.wav', 'noise3_snippet.wav', 16)
 		self.assertIsNone(Shz.identify('noise3_snippet.wav', 1, 0.0001))	# noise3_snippet doesn't match any song in the library
 
+		# test shazam.identify_aligned(): every window of the snippet agrees on offset 0
+		rst = Shz.identify_aligned('noise1_snippet.wav', 1, 0.0001)
+		self.assertEqual(rst[0], ((0, 'noise1.wav'), 15-10+1, 0))
+		self.assertIsNone(Shz.identify_aligned('noise3_snippet.wav', 1, 0.0001))
+
+		# test shazam.identify_many() with a burst of snippets, in and out of the library
+		results = Shz.identify_many(['noise1_snippet.wav', 'noise3_snippet.wav', 'noise2_snippet.wav'], 1, 0.0001, threads = 3)
+		self.assertEqual(results[0][0][0], (0, 'noise1.wav'))
+		self.assertIsNone(results[1])
+		self.assertEqual(results[2][0][0], (1, 'noise2.wav'))
+		self.assertEqual(Shz.identify_many([], 1, 0.0001), [])
+
+		# test shazam.tune(): the probes picked reach the target recall
+		num_probes, recall = Shz.tune(['noise1_snippet.wav', 'noise2_snippet.wav'], 0.9)
+		self.assertTrue(recall >= 0.9)
+		self.assertTrue(num_probes >= Shz.lsh.params.l)
+		self.assertEqual(Shz.lsh.num_probes, num_probes)
+
+		# a window without LSH candidates is a miss, even if its exact nearest entry is 0
+		Shz.lsh.query_windows = lambda windows, K, threads = 1: (np.zeros(len(windows), dtype = int),
+																 np.full(len(windows), np.inf))
+		self.assertEqual(Shz.lsh.tune_probes(['noise1_snippet.wav'], 0.9, Shz.lsh.params.l)[1], 0.0)
+		del Shz.lsh.query_windows
+
 		# test shazam.list()
 		self.assertTrue((0, 'noise1.wav') in Shz.list())
 		self.assertTrue((1, 'noise2.wav') in Shz.list())
 		self.assertFalse((2, 'noise3.wav') in Shz.list())
 
+		Shz.close()
+
+
+	def test_incremental(self):
+		"""test adding a second directory of songs without rebuilding the index"""
+
+		Shz = self.make_shazam()
+		indexed = Shz.lsh.signatures
+		n_songs = len(Shz.list())
+
+		directory = tempfile.mkdtemp()
+		writeWav(os.path.join(directory, 'noise4.wav'), 30)
+		self.assertTrue(Shz.insert_songs(directory))
+
+		self.assertIs(Shz.lsh.signatures, indexed)	# the LSH table was not rebuilt
+		self.assertEqual(len(Shz.lsh.delta), 30-10+1)
+		self.assertTrue(np.allclose(Shz.lsh.delta_norms, np.sum(Shz.lsh.delta**2, axis=1)))
+		self.assertTrue((n_songs, 'noise4.wav') in Shz.list())	# numbered after the existing songs
+
+		getSnippet(os.path.join(directory, 'noise4.wav'), 'noise4_snippet.wav', 12)
+		self.assertEqual(Shz.identify('noise4_snippet.wav', 1, 0.0001)[0][0], (n_songs, 'noise4.wav'))
+
+		# the exhaustive search covers the indexed signatures and the delta, block by block
+		windows = Song('noise4.wav', os.path.join(directory, 'noise4.wav')).analyzer()[:3] - Shz.lsh.mean
+		exact_ids, exact_distances = Shz.lsh.exact_windows(windows, block = 2, row_block = 7)
+		self.assertTrue(np.array_equal(exact_ids, len(indexed) + np.arange(3)))
+		self.assertTrue(np.allclose(exact_distances, 0, atol = 1e-4))
+
+		# the same directory again adds nothing
+		self.assertTrue(Shz.insert_songs(directory))
+		self.assertEqual(len(Shz.list()), n_songs + 1)
+
+		# merging the delta keeps every entry
+		Shz.lsh.merge()
+		self.assertEqual(len(Shz.lsh.delta), 0)
+		self.assertEqual(len(Shz.lsh.delta_norms), 0)
+		self.assertEqual(len(Shz.lsh.signatures), len(Shz.lsh.song_ids))
+		self.assertEqual(Shz.identify('noise4_snippet.wav', 1, 0.0001)[0][0], (n_songs, 'noise4.wav'))
+
+		os.remove('noise4_snippet.wav')
+		shutil.rmtree(directory)
+		Shz.close()
+
+
+	def test_streaming(self):
+		"""test identifying a live PCM feed, with early termination"""
+
+		Shz = self.make_shazam()
+
+		wavData = wv.open('noise2.wav', 'r')
+		feed = io.BytesIO(wavData.readframes(wavData.getnframes()))
+		size = len(feed.getvalue())
+
+		match = Shz.identify_stream(feed, 0.0001, votes = 3)
+		self.assertEqual(match[0], (1, 'noise2.wav'))
+		self.assertTrue(feed.tell() < size)	# stopped reading once 3 windows agreed
+
+		# chunks that split frames give the same windows
+		identifier = StreamIdentifier(Shz.lsh, 0.0001, votes = 2)
+		feed.seek(0)
+		while identifier.feed(feed.read(1001)) is None:
+			pass
+		self.assertEqual(identifier.match[0], (1, 'noise2.wav'))
+		self.assertEqual(identifier.windows, 2)
+
+		writeWav('noise5.wav', 15)
+		wavData = wv.open('noise5.wav', 'r')
+		feed = io.BytesIO(wavData.readframes(wavData.getnframes()))
+		self.assertIsNone(Shz.identify_stream(feed, 0.0001))	# not in the library
+		os.remove('noise5.wav')
+		Shz.close()
+
+
+	def test_fingerprints(self):
+		"""test the peak-pair hash fingerprints and their inverted index"""
+
+		song = Song('noise1.wav', 'noise1.wav')
+		hashes, times = song.fingerprints()
+		self.assertEqual(hashes.dtype, np.uint32)
+		self.assertEqual(len(hashes), len(times))
+		self.assertTrue(len(hashes) > 0)
+		self.assertTrue(len(hashes) * 3 * 4 < song.analyzer().nbytes / 10)	# far smaller than the signatures
+
+		# an in-memory index: a snippet lines up with the start of its song
+		index = FingerprintIndex()
+		index.add(hashes, np.zeros(len(hashes), dtype = int), times)
+		getSnippet('noise1.wav', 'noise1_snippet.wav', 15)
+		ranked = index.match(*Song('snippet', 'noise1_snippet.wav').fingerprints())
+		self.assertEqual(ranked[0][0], 0)
+		self.assertEqual(ranked[0][2], 0)
+
+		# the database table and the Shazam mode
+		Shz = self.make_shazam(signatures = False, fingerprints = True)
+		self.assertIsNone(Shz.lsh.table)
+
+		stored = db.get_fingerprints()
+		self.assertEqual(len(stored[0]), len(Shz.fingerprint_index.hashes))
+		self.assertEqual(stored[0].dtype, np.uint32)
+
+		getSnippet('noise2.wav', 'noise2_snippet.wav', 12)
+		self.assertEqual(Shz.identify_fingerprints('noise2_snippet.wav', 1)[0][0], (1, 'noise2.wav'))
+		writeWav('noise5.wav', 15)
+		self.assertIsNone(Shz.identify_fingerprints('noise5.wav', 1))
+		os.remove('noise5.wav')
+
+		# a library keeps the analyses it was built with, either way round
+		n_hashes = len(Shz.fingerprint_index.hashes)
+		self.assertRaises(ValueError, Shz.insert_songs, './')
+		self.assertRaises(ValueError, Shz.insert_songs, './', fingerprints = True)
+		self.assertEqual(len(db.get_entry_song_ids(Shz.pool)), 0)
+		self.assertEqual(len(Shz.fingerprint_index.hashes), n_hashes)
+		self.assertTrue(Shz.insert_songs('./', signatures = False, fingerprints = True))
+		Shz.close()
+
+		Shz = Shazam()
+		self.assertTrue(Shz.insert_songs('./'))
+		self.assertRaises(ValueError, Shz.insert_songs, './', signatures = False, fingerprints = True)
+		self.assertEqual(len(db.get_fingerprints(Shz.pool)[0]), 0)
+		Shz.close()
+
+
+	def test_parameters(self):
+		"""test that analysis and LSH parameters reach ingestion, the index and queries"""
+
+		Shz = self.make_shazam(width = 5, shift = 2, lsh_family = 'Hyperplane', num_tables = 12, num_probes = 24)
+
+		song = Song('noise1.wav', 'noise1.wav')
+		self.assertEqual(np.sum(Shz.lsh.song_ids == 0), len(song.analyzer(width = 5, shift = 2)))
+		self.assertEqual(Shz.lsh.params.l, 12)
+		self.assertEqual(Shz.lsh.params.lsh_family, falconn.LSHFamily.Hyperplane)
+		self.assertEqual(Shz.lsh.query_object.get_num_probes(), 24)
+
+		getSnippet('noise1.wav', 'noise1_snippet.wav', 15)
+		self.assertEqual(Shz.identify('noise1_snippet.wav', 1, 0.0001)[0][0], (0, 'noise1.wav'))
+		self.assertRaises(ValueError, Shz.lsh.set_num_probes, 11)	# fewer probes than tables
+		Shz.close()
+
+
+	def test_store(self):
+		"""test building the index from a memory-mapped signature store"""
+
+		directory = tempfile.mkdtemp()
+		store = SignatureStore(directory, width = 4)
+		store.append(np.ones((3, 4)), [0, 0, 0], [0, 1, 2])
+		store.append(np.zeros((2, 4)), [1, 1], [0, 1])
+		self.assertEqual(len(store), 5)
+		self.assertTrue(isinstance(store.signatures(), np.memmap))
+		self.assertEqual(list(store.song_ids()), [0, 0, 0, 1, 1])
+		self.assertEqual(list(store.offsets()), [0, 1, 2, 0, 1])
+		self.assertRaises(ValueError, store.append, np.ones((2, 3)), [0, 0], [0, 1])
+		self.assertEqual(len(SignatureStore(directory, width = 4, reset = True)), 0)
+
+		Shz = self.make_shazam(store = directory, projection = 'random', dimension = 64)
+
+		# the index maps the store's files instead of holding the signatures
+		self.assertEqual(len(Shz.lsh.store), len(db.get_entry_song_ids(Shz.pool)))
+		self.assertTrue(isinstance(Shz.lsh.signatures, np.memmap))
+		self.assertTrue(isinstance(Shz.lsh.points, np.memmap))
+		self.assertTrue(np.allclose(Shz.lsh.mean, np.mean(db.get_all_signatures(Shz.pool), axis = 0), atol = 1e-5))
+
+		getSnippet('noise1.wav', 'noise1_snippet.wav', 15)
+		self.assertEqual(Shz.identify('noise1_snippet.wav', 1, 0.0001)[0][0], (0, 'noise1.wav'))
+
+		# a merge rebuilds from the store into new files, and removes only the earlier builds
+		np.save(os.path.join(directory, 'mean.npy'), Shz.lsh.mean)
+		indexed = Shz.lsh.signatures
+		first = np.array(indexed[:2])
+		Shz.lsh.merge()
+		self.assertTrue(np.array_equal(indexed[:2], first))	# the earlier table's files are intact
+		self.assertEqual(sorted(f for f in os.listdir(directory) if f.endswith('.npy')),
+						 ['centered.1.npy', 'mean.npy', 'points.1.npy'])
+		self.assertEqual(Shz.identify('noise1_snippet.wav', 1, 0.0001)[0][0], (0, 'noise1.wav'))
+		Shz.close()
+		shutil.rmtree(directory)
+
+
+	def test_sharding(self):
+		"""test a sharded index gives the same matches as a single one"""
+
+		Shz = self.make_shazam(shards = 2)
+
+		# songs are partitioned by song_id across the shards
+		song_ids = db.get_entry_song_ids(Shz.pool)
+		self.assertEqual(Shz.lsh.sizes, [np.sum(song_ids % 2 == 0), np.sum(song_ids % 2 == 1)])
+
+		Hst = Hashtable(Shz.pool)
+		Hst.build_lsh(db.get_all_signatures(Shz.pool))
+		getSnippet('noise1.wav', 'noise1_snippet.wav', 15)
+		getSnippet('noise2.wav', 'noise2_snippet.wav', 12)
+		for path in ('noise1_snippet.wav', 'noise2_snippet.wav'):
+			self.assertEqual(Shz.identify(path, 3, 0.0001)[0], Hst.search_nearest(path, 3, 0.0001)[0])
+			self.assertEqual(Shz.identify_aligned(path, 1, 0.0001), Hst.search_aligned([path], 1, 0.0001)[0])
+
+		self.assertRaises(ValueError, Shazam, shards = 2, snapshot = './')
+		Shz.close()
+		self.assertFalse(any(process.is_alive() for process in Shz.lsh.processes))
+
+		# a shard that fails leaves no reply behind for the next command
+		sharded = ShardedHashtable(2)
+		signatures = Song('noise1.wav', 'noise1.wav').analyzer()
+		sharded.add(signatures, [0] * len(signatures))
+		self.assertRaises(ValueError, sharded.add, np.ones((4, 7)), [0, 0, 1, 1])	# wrong width for shard 0
+		self.assertEqual(sharded.sizes, [len(signatures), 2])
+		sharded.merge()
+		self.assertRaisesRegex(ValueError, 'broadcast', sharded.match_windows, signatures[:2], 1)
+		sharded.close()
+		self.assertFalse(any(process.is_alive() for process in sharded.processes))
+
+
+	def test_server(self):
+		"""test concurrent uploads to the identification server are batched"""
+
+		Shz = self.make_shazam()
+		getSnippet('noise1.wav', 'noise1_snippet.wav', 15)
+		getSnippet('noise2.wav', 'noise2_snippet.wav', 12)
+		server = IdentificationServer(Shz, K = 1, batch_delay = 0.05)
+
+		# a 24-bit stereo snippet, whose bytes can't be split into 16-bit stereo frames
+		wide = io.BytesIO()
+		with wv.open(wide, 'w') as output:
+			output.setparams((2, 3, 44100, 0, 'NONE', 'not compressed'))
+			output.writeframes(bytes(3 * 2 * (44100 * 12 + 1)))
+		wide = wide.getvalue()
+
+		async def post(port, body, target = '/identify'):
+			reader, writer = await asyncio.open_connection('127.0.0.1', port)
+			writer.write("POST {} HTTP/1.1\r\nContent-Length: {}\r\n\r\n"
+						 .format(target, len(body)).encode() + body)
+			response = await reader.read()
+			writer.close()
+			head, _, content = response.partition(b'\r\n\r\n')
+			return int(head.split()[1]), json.loads(content.decode())
+
+		async def run():
+			listening = await server.start(port = 0)
+			port = listening.sockets[0].getsockname()[1]
+			uploads = [open(path, 'rb').read() for path in ('noise1_snippet.wav', 'noise2_snippet.wav')] * 4
+			answers = await asyncio.gather(*[post(port, upload) for upload in uploads])
+			answers.append(await post(port, b'not a wave'))
+			answers.append(await post(port, uploads[0], '/songs'))
+			answers.append(await post(port, wide))
+			await server.stop()
+			return answers
+
+		answers = asyncio.run(run())
+		for i in range(8):
+			self.assertEqual(answers[i][0], 200)
+			self.assertEqual(answers[i][1]['matches'][0]['song_id'], i % 2)
+		self.assertEqual(answers[8][0], 400)
+		self.assertEqual(answers[9][0], 404)
+		self.assertEqual(answers[10][0], 400)
+		self.assertEqual(server.snippets, 8)
+		self.assertTrue(server.batches < 8)	# concurrent uploads share queries
+
+		# a snippet failing its analysis only fails its own request of the batch
+		results = server.search_batch([wide, uploads[1], uploads[0]])
+		self.assertIsInstance(results[0], ValueError)
+		self.assertEqual([songs_info[0][0] for songs_info, _ in results[1:]], [1, 0])
+		Shz.close()
+
+
+	def test_benchmark(self):
+		"""test the benchmark harness on a tiny synthetic library"""
+
+		results = benchmark.run(n_songs = 3, song_seconds = 15, n_snippets = 4,
+								snippet_seconds = 11, noise = 0, Ks = (1, 3))
+		self.assertEqual(set(results['ingest']), {'decode', 'analyze', 'lsh_build'})
+		self.assertEqual(results['signatures'], 3 * (15-10+1))
+		self.assertEqual(results['recall_at_K'], {'1': 1.0, '3': 1.0})	# snippets without noise
+		self.assertTrue(results['latency_seconds']['p50'] <= results['latency_seconds']['p99'])
+
+		# the database stage writes whole songs per transaction, as build_library does
+		written = benchmark.run(n_songs = 3, song_seconds = 15, n_snippets = 1, snippet_seconds = 11,
+								database = True, batch_size = 7)
+		self.assertIn('database', written['ingest'])
+		self.assertEqual(len(db.get_all_songs()), 3)
+		self.assertEqual(len(db.get_entry_song_ids()), 3 * (15-10+1))
+
+		# the same seed gives the same library
+		directory = tempfile.mkdtemp()
+		songs = benchmark.make_library(directory, 2, 1, seed = 7)
+		self.assertTrue(np.array_equal(songs[1], benchmark.make_library(directory, 2, 1, seed = 7)[1]))
+		shutil.rmtree(directory)
+
+		path = os.path.join(tempfile.mkdtemp(), 'results.json')
+		benchmark.save(results, path)
+		with open(path) as f:
+			self.assertEqual(json.load(f)['config']['n_songs'], 3)
+		shutil.rmtree(os.path.dirname(path))
+
+
+	def test_pool(self):
+		"""test the connection pool shared by the database helpers"""
+
+		pool = db.ConnectionPool(1, 2)
+
+		# more borrowers than connections wait for a free one instead of failing
+		for _ in range(5):
+			with db.connection(pool) as conn:
+				cur = conn.cursor()
+				cur.execute("SELECT 1")
+				self.assertEqual(cur.fetchone()[0], 1)
+
+		with db.connection(pool) as conn:
+			db.Database(conn).create_table()
+			self.assertFalse(conn.closed)	# a borrowed connection is left open
+
+		db.build_library("./", pool = pool)
+		self.assertEqual(db.get_song_info(0, pool)[1], db.get_song_info(0)[1])
+		self.assertEqual(len(db.get_all_songs(pool)), len(db.get_all_songs()))
+
+		# borrowers in many threads at once wait their turn, none is refused
+		answers = []
+		def borrow():
+			with db.connection(pool) as conn:
+				cur = conn.cursor()
+				cur.execute("SELECT pg_sleep(0.05), 1")
+				answers.append(cur.fetchone()[1])
+		threads = [threading.Thread(target = borrow) for _ in range(8)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join(10)
+		self.assertEqual(answers, [1] * 8)
+
+		# a connection that died while borrowed is dropped, and its slot is freed
+		for _ in range(3):
+			with db.connection(pool) as conn:
+				conn.close()
+		for _ in range(3):
+			with db.connection(pool) as conn:
+				self.assertFalse(conn.closed)
+				conn.cursor().execute("SELECT 1")
+		pool.closeall()
+
 
 def writeWav(filename, wave_length):
 	"""